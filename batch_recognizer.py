@@ -0,0 +1,125 @@
+import face_recognition
+import numpy as np
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+from face_recognizer import DEFAULT_LANDMARK_MODEL
+
+SHARED_FRAME_ALIGNMENT = 64 # Frames are placed on cache-line boundaries inside the shared memory block
+
+def attach_shared_memory(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False) # Python 3.13+, the parent owns the block
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+def detect_faces_in_shared_frames(shared_memory_name, frame_layouts, number_of_times_to_upsample, model, landmark_model, num_jitters):
+    """ Runs in a worker process: finds and encodes the faces of every frame laid out in the shared memory block """
+    block = attach_shared_memory(shared_memory_name)
+    try:
+        results = []
+        for offset, shape, dtype in frame_layouts:
+            frame = np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=offset)
+            face_locations = face_recognition.face_locations(frame, number_of_times_to_upsample=number_of_times_to_upsample, model=model)
+            face_encodings = face_recognition.face_encodings(frame, face_locations, num_jitters=num_jitters, model=landmark_model)
+            results.append((face_locations, face_encodings))
+            del frame # The block can't be closed while a view on it is alive
+        return results
+    finally:
+        block.close()
+
+class BatchFaceRecognizer():
+    """
+    Finds and encodes the faces of many frames at once by fanning them out to a pool of worker processes.
+
+    Frames are grouped in chunks of chunk_size frames, every chunk is copied once into a shared memory block that the
+    worker reads in place, so frames are never pickled. At most max_pending_chunks chunks are in flight at a time,
+    which bounds memory when the frames come from a long video. Results are returned in the order of the frames.
+
+    Use it as a context manager, or call .close() to shut the worker processes down.
+    """
+
+    def __init__(self, workers=None, chunk_size=4, max_pending_chunks=None, number_of_times_to_upsample=1, model='hog',
+                 landmark_model=DEFAULT_LANDMARK_MODEL, num_jitters=1):
+        self.workers = workers or os.cpu_count()
+        self.chunk_size = chunk_size
+        self.max_pending_chunks = max_pending_chunks or 2 * self.workers
+        self.number_of_times_to_upsample = number_of_times_to_upsample
+        self.model = model
+        self.landmark_model = landmark_model
+        self.num_jitters = num_jitters
+        self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def copy_to_shared_memory(self, frames):
+        """ Copies the frames into a new shared memory block, returns the block and the layout of every frame in it """
+        frame_layouts, size = [], 0
+        for frame in frames:
+            frame_layouts.append((size, frame.shape, frame.dtype.str))
+            size += -(-frame.nbytes // SHARED_FRAME_ALIGNMENT) * SHARED_FRAME_ALIGNMENT
+
+        block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for frame, (offset, shape, dtype) in zip(frames, frame_layouts):
+            np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=offset)[...] = frame
+        return block, frame_layouts
+
+    def submit(self, frames):
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        block, frame_layouts = self.copy_to_shared_memory(frames)
+        try:
+            future = self.pool.submit(detect_faces_in_shared_frames, block.name, frame_layouts,
+                                      self.number_of_times_to_upsample, self.model, self.landmark_model, self.num_jitters)
+        except Exception:
+            self.release(block)
+            raise
+        return future, block
+
+    def release(self, block):
+        block.close()
+        block.unlink()
+
+    def collect(self, pending_chunk):
+        future, block = pending_chunk
+        try:
+            return future.result()
+        finally:
+            self.release(block)
+
+    def detect_faces(self, frames):
+        """ Yields (face_locations, face_encodings) for every frame of the iterable, in order """
+        pending_chunks = deque()
+        chunk = []
+        try:
+            for frame in frames:
+                chunk.append(np.ascontiguousarray(frame))
+                if len(chunk) == self.chunk_size:
+                    pending_chunks.append(self.submit(chunk))
+                    chunk = []
+                while len(pending_chunks) >= self.max_pending_chunks:
+                    yield from self.collect(pending_chunks.popleft())
+            if chunk:
+                pending_chunks.append(self.submit(chunk))
+            while pending_chunks:
+                yield from self.collect(pending_chunks.popleft())
+        finally:
+            # The consumer stopped early or a worker failed, don't leak the blocks still in flight
+            for future, block in pending_chunks:
+                future.cancel()
+                try:
+                    future.exception()
+                except Exception:
+                    pass
+                self.release(block)
@@ -0,0 +1,257 @@
+from face_recognizer import FaceRecognizer, PermanentFaceStorage, ENCODING_SIZE
+from headless import IMAGE_EXTENSIONS
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import cv2
+import numpy as np
+
+def summarize(latencies, items_per_call=1):
+    """ Summarizes a list of latencies (in seconds) """
+    latencies = np.asarray(latencies)
+    return {'calls': len(latencies),
+            'p50_ms': float(np.percentile(latencies, 50) * 1000),
+            'p99_ms': float(np.percentile(latencies, 99) * 1000),
+            'mean_ms': float(latencies.mean() * 1000),
+            'throughput_per_s': float(items_per_call * len(latencies) / latencies.sum()) if latencies.sum() else None}
+
+def measure(operation, repeats, setup=None):
+    """ Times repeats calls of operation, setup runs before every call and is not timed """
+    latencies = []
+    # The storages print a line per removed face, keep that out of the measurements
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(repeats):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            operation()
+            latencies.append(time.perf_counter() - start)
+    return latencies
+
+def synthetic_encodings(random_generator, size):
+    """ Encodings spread like real ones: clusters of a few photos per identity, distances between identities well above 0.6 """
+    identities = random_generator.normal(scale=0.09, size=(max(size // 4, 1), ENCODING_SIZE)).astype(np.float32)
+    encodings = identities[random_generator.integers(0, len(identities), size)]
+    return encodings + random_generator.normal(scale=0.02, size=encodings.shape).astype(np.float32)
+
+def fill_storage(storage, encodings, last_seen=None):
+    """ Replaces the content of a storage by the given encodings, without going through add_face_to_dataset """
+    size = len(encodings)
+    encodings = np.ascontiguousarray(encodings, dtype=np.float32)
+    storage.identities.load_columns(encodings,
+                                    np.einsum('ij,ij->i', encodings, encodings),
+                                    np.arange(size, dtype=np.int64),
+                                    [f'Person {i}' for i in range(size)],
+                                    np.full(size, time.time() if last_seen is None else last_seen, dtype=np.float64),
+                                    np.full(size, storage.match_code, dtype=np.int8),
+                                    size)
+    if hasattr(storage, 'rebuild_expiry_heap'):
+        storage.rebuild_expiry_heap()
+
+def load_face_images(directory):
+    """ Reads the photos of a directory, each one is expected to show a single face """
+    face_images = []
+    for file_name in sorted(os.listdir(directory)):
+        if file_name.lower().endswith(IMAGE_EXTENSIONS):
+            face_image = cv2.imread(os.path.join(directory, file_name))
+            if face_image is not None:
+                face_images.append(face_image)
+    if not face_images:
+        raise ValueError(f"No photo found in {directory}")
+    return face_images
+
+def synthetic_frames(random_generator, face_images, count, width, height, faces_per_frame):
+    """ Frames showing faces_per_frame photos side by side on a noisy background, so both detection and encoding are measured """
+    frames = []
+    slot_width = width // faces_per_frame
+    for _ in range(count):
+        frame = random_generator.integers(0, 64, (height, width, 3), dtype=np.uint8)
+        for slot in range(faces_per_frame):
+            face_image = face_images[random_generator.integers(0, len(face_images))]
+            scale = random_generator.uniform(0.6, 0.9) * min(slot_width / face_image.shape[1], height / face_image.shape[0])
+            face_image = cv2.resize(face_image, (max(int(face_image.shape[1] * scale), 1), max(int(face_image.shape[0] * scale), 1)))
+            top = random_generator.integers(0, height - face_image.shape[0] + 1)
+            left = slot * slot_width + random_generator.integers(0, slot_width - face_image.shape[1] + 1)
+            frame[top:top + face_image.shape[0], left:left + face_image.shape[1]] = face_image
+        frames.append(frame)
+    return frames
+
+def video_frames(video_path, count):
+    video_capture = cv2.VideoCapture(video_path)
+    frames = []
+    while len(frames) < count:
+        ret, frame = video_capture.read()
+        if not ret:
+            break
+        frames.append(frame)
+    video_capture.release()
+    return frames
+
+def benchmark_detect_faces(face_recognizer, frames, resize_factor, repeats):
+    small_frames = [cv2.cvtColor(cv2.resize(frame, (0, 0), fx=resize_factor, fy=resize_factor), cv2.COLOR_BGR2RGB) for frame in frames]
+    frame_iterator = iter(small_frames * (repeats // len(small_frames) + 1))
+    face_counts = []
+
+    def detect_faces():
+        face_locations, _ = face_recognizer.detect_faces(next(frame_iterator))
+        face_counts.append(len(face_locations))
+
+    summary = summarize(measure(detect_faces, repeats))
+    # Every detected face is also encoded, so the latency is only comparable between runs finding as many faces
+    summary['faces_per_frame'] = float(np.mean(face_counts))
+    return summary
+
+def benchmark_retrieve_metadata(face_recognizer, gallery, random_generator, faces_per_frame, repeats):
+    # Half of the faces of a frame are known, the other half are strangers
+    known_count = faces_per_frame // 2
+    queries = []
+    for _ in range(repeats):
+        known = gallery[random_generator.integers(0, len(gallery), known_count)] + random_generator.normal(scale=0.02, size=(known_count, ENCODING_SIZE))
+        unknown = synthetic_encodings(random_generator, faces_per_frame - known_count)
+        queries.append(list(np.vstack((known, unknown))))
+    query_iterator = iter(queries)
+    return summarize(measure(lambda: face_recognizer.retrieve_metadata_from_faces(next(query_iterator)), repeats), faces_per_frame)
+
+def benchmark_clean(storage, random_generator, churn, repeats):
+    """ Every call has churn freshly expired faces to remove from the ephemeral storage """
+    expired = time.time() - storage.expiration_time * 3600 - 60
+
+    def add_expired_faces():
+        for face_encoding in synthetic_encodings(random_generator, churn):
+            storage.identities.add('Expired', face_encoding, expired, storage.match_code)
+        storage.rebuild_expiry_heap()
+
+    return summarize(measure(storage.clean, repeats, setup=add_expired_faces))
+
+def benchmark_cache(storage, random_generator, churn, repeats):
+    """ Times full snapshots, incremental saves of churn changes, and loading the cache back """
+    results = {'compact_cache': summarize(measure(lambda: storage.cache.compact(storage.identities), max(repeats // 10, 1)))}
+
+    def make_changes():
+        for face_encoding in synthetic_encodings(random_generator, churn):
+            storage.add_face_to_dataset('New', face_encoding)
+
+    # Keep the journal from being compacted so only incremental saves are measured
+    storage.cache.min_compaction_events = float('inf')
+    results['save_cache'] = summarize(measure(storage.save_cache, repeats, setup=make_changes))
+    results['load_cache'] = summarize(measure(lambda: PermanentFaceStorage(init_from_cache=True,
+                                                                           cache_path=storage.cache_path,
+                                                                           expiration_time=storage.expiration_time),
+                                              max(repeats // 10, 1)))
+    return results
+
+def run_benchmarks(args):
+    random_generator = np.random.default_rng(args.seed)
+    results = {}
+    cache_path = tempfile.mkdtemp(prefix='face-benchmark-')
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            face_recognizer = FaceRecognizer(init_from_cache=False, cache_path=cache_path, expiration_time=args.expiration_time,
+                                             ann_lists=args.ann_lists, ann_probes=args.ann_probes)
+
+        if 'detect_faces' in args.operations:
+            if args.video:
+                frames = video_frames(args.video, args.frames)
+            elif args.face_images:
+                frames = synthetic_frames(random_generator, load_face_images(args.face_images), args.frames, args.frame_width,
+                                          args.frame_height, args.frame_faces)
+            else:
+                frames = None
+                print("Skipping detect_faces: it needs frames showing faces, pass --video or --face-images", file=sys.stderr)
+            if frames:
+                results['detect_faces'] = benchmark_detect_faces(face_recognizer, frames, args.resize_factor, args.repeats)
+                print(f"detect_faces: {results['detect_faces']}", file=sys.stderr)
+
+        for gallery_size in args.gallery_sizes:
+            gallery = synthetic_encodings(random_generator, gallery_size)
+            fill_storage(face_recognizer.permanent_storage, gallery)
+            fill_storage(face_recognizer.ephemeral_storage, synthetic_encodings(random_generator, args.ephemeral_size))
+            if face_recognizer.permanent_storage.index is not None:
+                # Build in the foreground, so the index is used from the first measured match
+                face_recognizer.permanent_storage.build_index()
+
+            gallery_results = {}
+            if 'retrieve_metadata_from_faces' in args.operations:
+                gallery_results['retrieve_metadata_from_faces'] = benchmark_retrieve_metadata(face_recognizer, gallery, random_generator,
+                                                                                              args.faces_per_frame, args.repeats)
+            if 'clean' in args.operations:
+                gallery_results['clean'] = benchmark_clean(face_recognizer.ephemeral_storage, random_generator, args.churn, args.repeats)
+            if 'save_cache' in args.operations or 'load_cache' in args.operations:
+                face_recognizer.permanent_storage.cache.generation = None
+                gallery_results.update(benchmark_cache(face_recognizer.permanent_storage, random_generator, args.churn, args.repeats))
+
+            for operation, summary in gallery_results.items():
+                results[f'{operation}[gallery={gallery_size}]'] = summary
+                print(f"{operation}[gallery={gallery_size}]: {summary}", file=sys.stderr)
+    finally:
+        shutil.rmtree(cache_path, ignore_errors=True)
+    return results
+
+def compare_with_baseline(results, baseline, tolerance):
+    """ Returns the benchmarks whose p50 or p99 latency got worse than the baseline by more than tolerance, or that ran on different faces """
+    regressions = []
+    for name, summary in results.items():
+        if name not in baseline:
+            continue
+        if summary.get('faces_per_frame') != baseline[name].get('faces_per_frame'):
+            regressions.append(f"{name}: {baseline[name].get('faces_per_frame')} -> {summary.get('faces_per_frame')} faces per frame, "
+                               "the frames differ from the baseline's")
+            continue
+        for metric in ('p50_ms', 'p99_ms'):
+            if summary[metric] > baseline[name][metric] * (1 + tolerance):
+                regressions.append(f"{name} {metric}: {baseline[name][metric]:.3f} -> {summary[metric]:.3f}")
+    return regressions
+
+if __name__ == "__main__":
+    # Parse the command line arguments
+    parser = argparse.ArgumentParser(description='Benchmarks face detection, matching, expiry and cache I/O on synthetic data')
+    parser.add_argument('--operations', nargs='+', default=['detect_faces', 'retrieve_metadata_from_faces', 'clean', 'save_cache', 'load_cache'], dest="operations", help='Operations to benchmark')
+    parser.add_argument('--gallery-sizes', nargs='+', type=int, default=[1000, 10000, 100000], dest="gallery_sizes", help='Number of faces in the permanent storage, e.g. 1000 10000 100000 1000000')
+    parser.add_argument('--ephemeral-size', type=int, default=1000, dest="ephemeral_size", help='Number of faces in the ephemeral storage')
+    parser.add_argument('--churn', type=int, default=50, dest="churn", help='Faces expired before every clean and added before every save')
+    parser.add_argument('--faces-per-frame', type=int, default=4, dest="faces_per_frame", help='Faces matched per call of retrieve_metadata_from_faces')
+    parser.add_argument('--repeats', type=int, default=100, dest="repeats", help='Number of timed calls per operation')
+    parser.add_argument('--video', type=str, default=None, dest="video", help='Video file used for detect_faces')
+    parser.add_argument('--face-images', type=str, default=None, dest="face_images", help='Directory of photos showing one face each, pasted into generated frames for detect_faces when no --video is given')
+    parser.add_argument('--frame-faces', type=int, default=2, dest="frame_faces", help='Number of photos pasted into every generated frame')
+    parser.add_argument('--frames', type=int, default=20, dest="frames", help='Number of distinct frames used for detect_faces')
+    parser.add_argument('--frame-width', type=int, default=640, dest="frame_width", help='Width of the generated frames')
+    parser.add_argument('--frame-height', type=int, default=480, dest="frame_height", help='Height of the generated frames')
+    parser.add_argument('--resize-factor', type=float, default=0.25, dest="resize_factor", help='Amount to resize the frames before detection')
+    parser.add_argument('--expiration-time', type=float, default=0.5, dest="expiration_time", help='Expiration time of the ephemeral storage in hours')
+    parser.add_argument('--ann-lists', type=int, default=None, dest="ann_lists", help='Benchmark the permanent storage with an approximate nearest-neighbor index with this many clusters')
+    parser.add_argument('--ann-probes', type=int, default=16, dest="ann_probes", help='Number of index clusters scanned per face')
+    parser.add_argument('--seed', type=int, default=0, dest="seed", help='Seed of the synthetic data')
+    parser.add_argument('--output', type=str, default='-', dest="output", help='File the JSON results are written to. Defaults to stdout.')
+    parser.add_argument('--baseline', type=str, default=None, dest="baseline", help='JSON results of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, dest="tolerance", help='Relative slowdown over the baseline reported as a regression')
+    args = parser.parse_args()
+
+    report = {'environment': {'python': platform.python_version(),
+                              'numpy': np.__version__,
+                              'platform': platform.platform(),
+                              'cpu_count': os.cpu_count()},
+              'config': vars(args),
+              'results': run_benchmarks(args)}
+
+    if args.output == '-':
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_with_baseline(report['results'], json.load(f)['results'], args.tolerance)
+        if regressions:
+            print("Regressions against the baseline:", file=sys.stderr)
+            for regression in regressions:
+                print(f"  {regression}", file=sys.stderr)
+            exit(1)
+        print("No regression against the baseline", file=sys.stderr)
@@ -0,0 +1,110 @@
+import face_recognition
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from headless import IMAGE_EXTENSIONS
+from face_recognizer import DEFAULT_LANDMARK_MODEL
+
+def list_labeled_photos(directory):
+    """ Returns the (name, path) of every photo of a name/*.jpg directory tree, sorted by path """
+    labeled_photos = []
+    for name in sorted(os.listdir(directory)):
+        person_directory = os.path.join(directory, name)
+        if not os.path.isdir(person_directory):
+            continue
+        for file_name in sorted(os.listdir(person_directory)):
+            if file_name.lower().endswith(IMAGE_EXTENSIONS):
+                labeled_photos.append((name, os.path.join(person_directory, file_name)))
+    return labeled_photos
+
+def encode_photo(path):
+    """ Runs in a worker process: returns (status, encoding), only photos showing exactly one face are encoded """
+    try:
+        image = face_recognition.load_image_file(path)
+    except Exception as exc:
+        return f'unreadable: {exc}', None
+    face_locations = face_recognition.face_locations(image)
+    if len(face_locations) != 1:
+        return 'no_face' if not face_locations else 'multiple_faces', None
+    return 'ok', face_recognition.face_encodings(image, face_locations, model=DEFAULT_LANDMARK_MODEL)[0].tolist()
+
+def read_checkpoint(checkpoint_path):
+    """ Returns {path: (status, encoding)} for the photos processed by a previous, interrupted run """
+    processed = {}
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path, 'rb+') as f:
+            valid_size = 0
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                entry = json.loads(line)
+                processed[entry['path']] = (entry['status'], entry['encoding'])
+                valid_size += len(line)
+            # Drop the line the interrupted run was writing, so new entries are appended after a complete line
+            f.truncate(valid_size)
+    return processed
+
+def deduplicate(names, encodings, permanent_storage, threshold):
+    """ Keeps only the encodings farther than threshold from every kept or stored encoding of the same identity """
+    kept_indices = []
+    # Gather the stored encodings of the enrolled names in one pass over the gallery
+    kept_by_name = {name: [] for name in names}
+    stored_encodings = permanent_storage.identities.encodings
+    for row, stored_name in enumerate(permanent_storage.identities.names):
+        kept = kept_by_name.get(stored_name)
+        if kept is not None:
+            kept.append(stored_encodings[row])
+    for i, (name, encoding) in enumerate(zip(names, encodings)):
+        kept = kept_by_name[name]
+        if kept and np.linalg.norm(np.asarray(kept) - encoding, axis=1).min() <= threshold:
+            continue
+        kept.append(encoding)
+        kept_indices.append(i)
+    return kept_indices
+
+def enroll_directory(permanent_storage, directory, workers=None, dedup_threshold=0.15, checkpoint_path=None):
+    """
+    Enrolls every photo of a name/*.jpg directory tree into the permanent storage.
+
+    Photos are encoded in parallel on a process pool and skipped when they show zero or several faces.
+    Every processed photo is appended to a checkpoint file, so an interrupted run resumes where it stopped.
+    Near-identical encodings of the same identity (closer than dedup_threshold) are only enrolled once, then all the
+    faces are added to the storage and saved in one batch. Returns a dict counting the photos per outcome.
+    """
+    checkpoint_path = checkpoint_path or os.path.join(directory, '.enroll_checkpoint.jsonl')
+    labeled_photos = list_labeled_photos(directory)
+    processed = read_checkpoint(checkpoint_path)
+    remaining_paths = [path for _, path in labeled_photos if path not in processed]
+    print(f"Enrolling {len(labeled_photos)} photos from {directory}, {len(labeled_photos) - len(remaining_paths)} already processed")
+
+    with open(checkpoint_path, 'a') as checkpoint, ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(encode_photo, remaining_paths, chunksize=8)
+        for done, (path, (status, encoding)) in enumerate(zip(remaining_paths, results), 1):
+            processed[path] = (status, encoding)
+            checkpoint.write(json.dumps({'path': path, 'status': status, 'encoding': encoding}) + '\n')
+            if done % 100 == 0:
+                checkpoint.flush()
+                print(f"Processed {done}/{len(remaining_paths)} photos")
+
+    summary = {}
+    names, encodings = [], []
+    for name, path in labeled_photos:
+        status, encoding = processed[path]
+        summary[status] = summary.get(status, 0) + 1
+        if status == 'ok':
+            names.append(name)
+            encodings.append(np.asarray(encoding, dtype=np.float32))
+
+    kept_indices = deduplicate(names, encodings, permanent_storage, dedup_threshold)
+    summary['duplicates'] = len(names) - len(kept_indices)
+    summary['enrolled'] = len(kept_indices)
+    if kept_indices:
+        permanent_storage.add_faces_to_dataset([names[i] for i in kept_indices], [encodings[i] for i in kept_indices])
+        permanent_storage.save_cache()
+
+    # The faces are saved, a new run must start from scratch
+    os.remove(checkpoint_path)
+    print(f"Enrollment done: {summary}")
+    return summary
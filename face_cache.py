@@ -0,0 +1,198 @@
+import os
+import struct
+import numpy as np
+
+JOURNAL_ADD = 1
+JOURNAL_REMOVE = 2
+JOURNAL_TOUCH = 3
+
+# op, face_id, timestamp, code, length of the utf-8 name. ADD records are followed by the name and the float32 encoding.
+JOURNAL_RECORD_HEADER = struct.Struct('<Bqdbh')
+
+class FaceCache():
+    """
+    Binary on-disk cache of an IdentityTable, stored in its own directory:
+    MANIFEST           = generation number of the current snapshot, replaced atomically
+    encodings.<g>.npy  = float32 (N, 128) encodings, opened memory-mapped so startup doesn't read them
+    metadata.<g>.npz   = the other columns (ids, squared norms, last seen, codes, names as one utf-8 blob + offsets)
+    journal.<g>.bin    = append-only add/remove/touch events that happened after snapshot g was written
+
+    Saving appends the pending events to the journal, the snapshot is only rewritten (compacted) once the journal
+    gets large compared to the number of faces, or when replaying the journal at load had to copy the encodings.
+    The files of a snapshot are flushed to disk before the manifest points to them.
+    """
+
+    def __init__(self, cache_path, cache_name, compaction_ratio=0.5, min_compaction_events=1000):
+        self.directory = os.path.join(cache_path, cache_name)
+        self.compaction_ratio = compaction_ratio
+        self.min_compaction_events = min_compaction_events
+        self.generation = None # None until memory and disk share a snapshot
+        self.journal_events = 0
+        self.pending_events = bytearray()
+        self.pending_events_count = 0
+
+    def path(self, file_name):
+        return os.path.join(self.directory, file_name)
+
+    def exists(self):
+        return os.path.exists(self.path('MANIFEST'))
+
+    # Events
+    def record(self, op, face_id, timestamp=0.0, code=0, name=b'', face_encoding=None):
+        self.pending_events += JOURNAL_RECORD_HEADER.pack(op, face_id, timestamp, code, len(name))
+        if op == JOURNAL_ADD:
+            self.pending_events += name
+            self.pending_events += np.asarray(face_encoding, dtype='<f4').tobytes()
+        self.pending_events_count += 1
+
+    def record_add(self, face_id, name, face_encoding, last_seen, code):
+        self.record(JOURNAL_ADD, face_id, last_seen, code, (name or '').encode('utf-8'), face_encoding)
+
+    def record_remove(self, face_id):
+        self.record(JOURNAL_REMOVE, face_id)
+
+    def record_touch(self, face_id, last_seen):
+        self.record(JOURNAL_TOUCH, face_id, last_seen)
+
+    # Reading
+    def load(self, identities):
+        """ Fills an empty IdentityTable from the snapshot and replays the journal on top of it """
+        with open(self.path('MANIFEST')) as f:
+            self.generation = int(f.read())
+
+        encodings = np.load(self.path(f'encodings.{self.generation}.npy'), mmap_mode='r')
+        with np.load(self.path(f'metadata.{self.generation}.npz')) as metadata:
+            name_bytes = metadata['name_bytes'].tobytes()
+            name_offsets = metadata['name_offsets'].tolist()
+            names = [name_bytes[start:end].decode('utf-8') for start, end in zip(name_offsets[:-1], name_offsets[1:])]
+            identities.load_columns(encodings, metadata['squared_norms'], metadata['ids'], names,
+                                    metadata['last_seen'], metadata['codes'], int(metadata['next_face_id']))
+
+        self.journal_events = self.replay_journal(identities)
+        self.pending_events = bytearray()
+        self.pending_events_count = 0
+        if self.journal_events and identities.encodings.flags.writeable:
+            # Replaying adds or removes copied the memory-mapped encodings, write them out so the next start maps them again
+            self.compact(identities)
+        else:
+            self.remove_stale_generations()
+
+    def replay_journal(self, identities):
+        """ Applies the journal events to the table, returns the number of events. A torn trailing record is dropped. """
+        journal_path = self.path(f'journal.{self.generation}.bin')
+        if not os.path.exists(journal_path):
+            return 0
+        with open(journal_path, 'rb') as f:
+            journal = f.read()
+
+        encoding_size = 4 * identities.encoding_size
+        offset, events = 0, 0
+        while offset + JOURNAL_RECORD_HEADER.size <= len(journal):
+            op, face_id, timestamp, code, name_length = JOURNAL_RECORD_HEADER.unpack_from(journal, offset)
+            record_end = offset + JOURNAL_RECORD_HEADER.size
+            if op == JOURNAL_ADD:
+                record_end += name_length + encoding_size
+            if record_end > len(journal):
+                break
+
+            # Events are idempotent so replaying a journal twice is harmless
+            if op == JOURNAL_ADD and face_id not in identities:
+                name_start = offset + JOURNAL_RECORD_HEADER.size
+                name = journal[name_start:name_start + name_length].decode('utf-8')
+                face_encoding = np.frombuffer(journal, dtype='<f4', count=identities.encoding_size, offset=name_start + name_length)
+                identities.add(name, face_encoding, timestamp, code, face_id=face_id)
+            elif op == JOURNAL_REMOVE and face_id in identities:
+                identities.remove(face_id)
+            elif op == JOURNAL_TOUCH and face_id in identities:
+                identities.touch(face_id, timestamp)
+            offset = record_end
+            events += 1
+
+        if offset != len(journal):
+            print("The face cache journal ends with an incomplete event, dropping it.")
+            with open(journal_path, 'r+b') as f:
+                f.truncate(offset)
+        return events
+
+    # Writing
+    def save(self, identities):
+        """ Appends the pending events to the journal, compacting it into a new snapshot when it gets too large """
+        if self.generation is None or self.journal_events + self.pending_events_count > max(self.min_compaction_events, self.compaction_ratio * len(identities)):
+            self.compact(identities)
+            return
+
+        with open(self.path(f'journal.{self.generation}.bin'), 'ab') as f:
+            f.write(self.pending_events)
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal_events += self.pending_events_count
+        self.pending_events = bytearray()
+        self.pending_events_count = 0
+
+    def compact(self, identities):
+        """ Writes the whole table as a new snapshot generation with an empty journal """
+        os.makedirs(self.directory, exist_ok=True)
+        generation = (self.generation or self.read_generation()) + 1
+
+        encoded_names = [(name or '').encode('utf-8') for name in identities.names]
+        name_offsets = np.zeros(len(encoded_names) + 1, dtype=np.int64)
+        np.cumsum([len(name) for name in encoded_names], out=name_offsets[1:])
+
+        def write_metadata(f):
+            np.savez(f,
+                     ids=identities.ids,
+                     squared_norms=identities.squared_norms,
+                     last_seen=identities.last_seen,
+                     codes=identities.codes,
+                     name_bytes=np.frombuffer(b''.join(encoded_names), dtype=np.uint8),
+                     name_offsets=name_offsets,
+                     next_face_id=identities.next_face_id)
+
+        self.write_file(f'encodings.{generation}.npy', lambda f: np.save(f, identities.encodings))
+        self.write_file(f'metadata.{generation}.npz', write_metadata)
+        self.write_file(f'journal.{generation}.bin', lambda f: None)
+
+        # The new generation only becomes visible once the manifest points to it, after all its files are on disk
+        self.write_file('MANIFEST.tmp', lambda f: f.write(str(generation).encode('ascii')))
+        self.fsync_directory()
+        os.replace(self.path('MANIFEST.tmp'), self.path('MANIFEST'))
+        # The previous generation is removed below, the new manifest must be on disk first
+        self.fsync_directory()
+
+        self.generation = generation
+        self.journal_events = 0
+        self.pending_events = bytearray()
+        self.pending_events_count = 0
+        self.remove_stale_generations()
+
+    def write_file(self, file_name, write):
+        """ Writes a file of the cache with write(f) and flushes it to disk """
+        with open(self.path(file_name), 'wb') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def fsync_directory(self):
+        """ Flushes the entries of the cache directory (created and renamed files), directories can't be opened on Windows """
+        if os.name == 'nt':
+            return
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def read_generation(self):
+        if not self.exists():
+            return 0
+        with open(self.path('MANIFEST')) as f:
+            return int(f.read())
+
+    def remove_stale_generations(self):
+        for file_name in os.listdir(self.directory):
+            parts = file_name.split('.')
+            if len(parts) == 3 and parts[1].isdigit() and int(parts[1]) != self.generation:
+                try:
+                    os.remove(self.path(file_name))
+                except OSError:
+                    pass # Still memory-mapped on some platforms, it will be removed next time
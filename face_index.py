@@ -0,0 +1,160 @@
+import numpy as np
+
+class IVFIndex():
+    """
+    Approximate nearest-neighbor index over face encodings using an inverted file (IVF):
+    the encodings are clustered with k-means and every face is filed under its nearest centroid.
+    A query only scans the faces filed under its n_probe nearest centroids, so n_probe is the recall/speed knob
+    (n_probe = n_lists scans everything and is exact).
+
+    The index only stores the rows of the caller's encoding matrix, the candidate rows it returns are meant to be
+    re-ranked exactly by the caller. Rows can be added, moved and removed incrementally once the index is trained.
+    Encodings are assigned to their centroid assignment_chunk_size rows at a time, so building over a million faces
+    never holds more than a chunk of the (rows x n_lists) distance matrix in memory.
+    """
+
+    def __init__(self, n_lists=1024, n_probe=16, kmeans_iterations=10, max_training_points_per_list=64, assignment_chunk_size=16384, seed=0):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.kmeans_iterations = kmeans_iterations
+        self.max_training_points_per_list = max_training_points_per_list
+        self.assignment_chunk_size = assignment_chunk_size
+        self.seed = seed
+        self.random_generator = np.random.default_rng(seed)
+        self.centroids = None
+        self.centroid_squared_norms = None
+        self.lists = [] # One array of rows per centroid, over-allocated and grown by doubling
+        self.list_sizes = None
+        # List number and position in that list of every indexed row, indexed by row
+        self.row_lists = np.empty(0, dtype=np.int32)
+        self.row_positions = np.empty(0, dtype=np.int64)
+        self.size = 0
+        self.trained_size = 0 # Number of faces the centroids were trained on
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def untrained_copy(self):
+        """ Returns an empty index with the same parameters, to be built while this one keeps serving searches """
+        return IVFIndex(n_lists=self.n_lists, n_probe=self.n_probe, kmeans_iterations=self.kmeans_iterations,
+                        max_training_points_per_list=self.max_training_points_per_list,
+                        assignment_chunk_size=self.assignment_chunk_size, seed=self.seed)
+
+    def min_training_size(self):
+        """ Below this number of faces the clusters are not meaningful and a linear scan is cheap anyway """
+        return 39 * self.n_lists
+
+    def squared_distances_to_centroids(self, encodings):
+        squared_distances = np.einsum('ij,ij->i', encodings, encodings)[:, np.newaxis] + self.centroid_squared_norms[np.newaxis, :]
+        squared_distances -= 2 * (encodings @ self.centroids.T)
+        return squared_distances
+
+    def assign(self, encodings):
+        """ Returns the number of the nearest centroid of every encoding """
+        assignments = np.empty(len(encodings), dtype=np.int64)
+        for start in range(0, len(encodings), self.assignment_chunk_size):
+            chunk = encodings[start:start + self.assignment_chunk_size]
+            assignments[start:start + len(chunk)] = self.squared_distances_to_centroids(chunk).argmin(axis=1)
+        return assignments
+
+    def train(self, encodings):
+        """ Runs k-means over (a sample of) the encodings to find the centroids. Clears the index. """
+        encodings = np.asarray(encodings, dtype=np.float32)
+        n_lists = min(self.n_lists, len(encodings))
+        max_training_points = n_lists * self.max_training_points_per_list
+        if len(encodings) > max_training_points:
+            encodings = encodings[self.random_generator.choice(len(encodings), max_training_points, replace=False)]
+
+        self.centroids = encodings[self.random_generator.choice(len(encodings), n_lists, replace=False)].copy()
+        for _ in range(self.kmeans_iterations):
+            self.centroid_squared_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+            assignments = self.assign(encodings)
+            counts = np.bincount(assignments, minlength=n_lists)
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, assignments, encodings)
+            non_empty = counts > 0
+            self.centroids[non_empty] = sums[non_empty] / counts[non_empty, np.newaxis]
+            # Re-seed empty clusters with random points so no list is wasted
+            n_empty = int((~non_empty).sum())
+            if n_empty:
+                self.centroids[~non_empty] = encodings[self.random_generator.choice(len(encodings), n_empty)]
+        self.centroid_squared_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+
+        self.lists = [np.empty(8, dtype=np.int64) for _ in range(n_lists)]
+        self.list_sizes = np.zeros(n_lists, dtype=np.int64)
+        self.row_lists = np.full(len(self.row_lists), -1, dtype=np.int32)
+        self.size = 0
+
+    def build(self, encodings):
+        """ Trains the index on the given encodings and adds all of them, row i being encodings[i] """
+        self.train(encodings)
+        self.add_many(np.arange(len(encodings)), encodings)
+        self.trained_size = len(encodings)
+
+    def add_many(self, rows, encodings):
+        """ Files the rows under their nearest centroid, every list receiving its new rows in one slice """
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) == 0:
+            return
+        assignments = self.assign(np.asarray(encodings, dtype=np.float32).reshape(len(rows), -1))
+        if rows.max() >= len(self.row_lists):
+            capacity = max(2 * len(self.row_lists), int(rows.max()) + 1)
+            self.row_lists = np.concatenate((self.row_lists, np.full(capacity - len(self.row_lists), -1, dtype=np.int32)))
+            self.row_positions = np.concatenate((self.row_positions, np.zeros(capacity - len(self.row_positions), dtype=np.int64)))
+
+        order = np.argsort(assignments, kind='stable')
+        rows, assignments = rows[order], assignments[order]
+        list_numbers, starts, counts = np.unique(assignments, return_index=True, return_counts=True)
+        for list_number, start, count in zip(list_numbers.tolist(), starts.tolist(), counts.tolist()):
+            size = int(self.list_sizes[list_number])
+            if size + count > len(self.lists[list_number]):
+                grown = np.empty(max(2 * len(self.lists[list_number]), size + count), dtype=np.int64)
+                grown[:size] = self.lists[list_number][:size]
+                self.lists[list_number] = grown
+            list_rows = rows[start:start + count]
+            self.lists[list_number][size:size + count] = list_rows
+            self.list_sizes[list_number] = size + count
+            self.row_lists[list_rows] = list_number
+            self.row_positions[list_rows] = np.arange(size, size + count)
+        self.size += len(rows)
+
+    def add(self, row, encoding):
+        self.add_many([row], np.asarray(encoding, dtype=np.float32)[np.newaxis, :])
+
+    def move(self, old_row, new_row):
+        """ Records that the face stored in old_row of the caller's encoding matrix now lives in new_row """
+        list_number, position = self.row_lists[old_row], self.row_positions[old_row]
+        self.lists[list_number][position] = new_row
+        self.row_lists[new_row], self.row_positions[new_row] = list_number, position
+        self.row_lists[old_row] = -1
+
+    def remove(self, row):
+        """ Removes a row by moving the last entry of its list into its slot """
+        list_number, position = self.row_lists[row], self.row_positions[row]
+        rows = self.lists[list_number]
+        last = self.list_sizes[list_number] - 1
+        if position != last:
+            rows[position] = rows[last]
+            self.row_positions[rows[position]] = position
+        self.list_sizes[list_number] = last
+        self.row_lists[row] = -1
+        self.size -= 1
+
+    def search(self, queries, n_probe=None):
+        """ Returns, for every query, the array of candidate rows filed under its n_probe nearest centroids """
+        n_probe = min(n_probe or self.n_probe, len(self.centroids))
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.centroids.shape[1])
+        squared_distances = self.squared_distances_to_centroids(queries)
+        if n_probe < len(self.centroids):
+            probed_lists = np.argpartition(squared_distances, n_probe - 1, axis=1)[:, :n_probe]
+        else:
+            probed_lists = np.broadcast_to(np.arange(len(self.centroids)), squared_distances.shape)
+
+        candidates = []
+        for lists in probed_lists:
+            candidates.append(np.concatenate([self.lists[l][:self.list_sizes[l]] for l in lists.tolist()]))
+        return candidates
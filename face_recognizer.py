@@ -3,145 +3,477 @@ import pickle as pkl
 import os
 import numpy as np
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
+import time
+import heapq
+import threading
+from face_index import IVFIndex
+from face_cache import FaceCache
+from locks import ReadWriteLock
+from metrics import NullMetrics
+
+ENCODING_SIZE = 128 # Length of the face encodings produced by face_recognition
+DEFAULT_TOLERANCE = 0.6 # Same default tolerance as face_recognition.compare_faces
+DEFAULT_LANDMARK_MODEL = 'small' # Same default landmark model as face_recognition.face_encodings, the gallery is encoded with it
+
+class IdentityTable():
+    """ 
+    Column store holding the faces of a FaceStorage. Row i of every column describes the same face:
+    encodings (float32, N x 128), squared_norms (float32), ids (int64), names (str), last_seen (float64 POSIX timestamp), codes (int8)
+
+    Columns are over-allocated and grown by doubling, and a face is removed by moving the last row into its slot,
+    so adding and removing a face are both amortized O(1). Identity IDs are never reused.
+    Columns loaded from the cache may be read-only memory maps, they are copied the first time a row is added or removed.
+    """
+
+    __slots__ = ('_encodings', '_squared_norms', '_ids', '_names', '_last_seen', '_codes', '_rows', '_size', 'next_face_id')
+
+    def __init__(self, capacity=64):
+        self._encodings = np.empty((capacity, ENCODING_SIZE), dtype=np.float32)
+        self._squared_norms = np.empty(capacity, dtype=np.float32) # Cached to avoid recomputing them on every match
+        self._ids = np.empty(capacity, dtype=np.int64)
+        self._names = []
+        self._last_seen = np.empty(capacity, dtype=np.float64)
+        self._codes = np.empty(capacity, dtype=np.int8)
+        self._rows = {} # face_id -> row
+        self._size = 0
+        self.next_face_id = 0
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, face_id):
+        return face_id in self._rows
+
+    # Views over the valid rows of each column
+    @property
+    def encodings(self):
+        return self._encodings[:self._size]
+
+    @property
+    def squared_norms(self):
+        return self._squared_norms[:self._size]
+
+    @property
+    def names(self):
+        return self._names
+
+    @property
+    def encoding_size(self):
+        return self._encodings.shape[1]
+
+    @property
+    def ids(self):
+        return self._ids[:self._size]
+
+    @property
+    def last_seen(self):
+        return self._last_seen[:self._size]
+
+    @property
+    def codes(self):
+        return self._codes[:self._size]
+
+    def row_of(self, face_id):
+        return self._rows[face_id]
+
+    def name_of(self, face_id):
+        return self._names[self._rows[face_id]]
+
+    def last_seen_of(self, face_id):
+        return float(self._last_seen[self._rows[face_id]])
+
+    def code_of(self, face_id):
+        return int(self._codes[self._rows[face_id]])
+
+    def load_columns(self, encodings, squared_norms, ids, names, last_seen, codes, next_face_id):
+        """ Replaces the content of the table by the given columns, which are used as they are (no copy) """
+        self._encodings, self._squared_norms, self._ids, self._last_seen, self._codes = encodings, squared_norms, ids, last_seen, codes
+        self._names = list(names)
+        self._rows = dict(zip(ids.tolist(), range(len(ids))))
+        self._size = len(ids)
+        self.next_face_id = next_face_id
+
+    def _grow(self, capacity):
+        for column in ('_encodings', '_squared_norms', '_ids', '_last_seen', '_codes'):
+            old = getattr(self, column)
+            new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, column, new)
+
+    def add(self, name, face_encoding, last_seen, code, face_id=None):
+        """ Appends a face and returns its identity ID """
+        if face_id is None:
+            face_id = self.next_face_id
+        self.next_face_id = max(self.next_face_id, face_id + 1)
+        if self._size == len(self._ids) or not self._encodings.flags.writeable:
+            self._grow(max(2 * self._size, len(self._ids), 1))
+
+        row = self._size
+        self._encodings[row] = face_encoding
+        self._squared_norms[row] = np.dot(self._encodings[row], self._encodings[row])
+        self._ids[row] = face_id
+        self._names.append(name)
+        self._last_seen[row] = last_seen
+        self._codes[row] = code
+        self._rows[face_id] = row
+        self._size += 1
+        return face_id
+
+    def add_many(self, names, face_encodings, last_seen, code):
+        """ Appends many faces at once and returns the array of their identity IDs """
+        count = len(names)
+        if self._size + count > len(self._ids) or not self._encodings.flags.writeable:
+            self._grow(max(2 * self._size, self._size + count, len(self._ids), 1))
+
+        rows = slice(self._size, self._size + count)
+        face_ids = np.arange(self.next_face_id, self.next_face_id + count, dtype=np.int64)
+        self._encodings[rows] = face_encodings
+        self._squared_norms[rows] = np.einsum('ij,ij->i', self._encodings[rows], self._encodings[rows])
+        self._ids[rows] = face_ids
+        self._names.extend(names)
+        self._last_seen[rows] = last_seen
+        self._codes[rows] = code
+        self._rows.update(zip(face_ids.tolist(), range(rows.start, rows.stop)))
+        self._size += count
+        self.next_face_id += count
+        return face_ids
+
+    def remove(self, face_id):
+        """ Removes a face by moving the last row into its slot, returns the name of the removed face """
+        if not self._encodings.flags.writeable:
+            self._grow(len(self._ids))
+        row = self._rows.pop(face_id)
+        last = self._size - 1
+        name = self._names[row]
+        if row != last:
+            self._encodings[row] = self._encodings[last]
+            self._squared_norms[row] = self._squared_norms[last]
+            self._ids[row] = self._ids[last]
+            self._names[row] = self._names[last]
+            self._last_seen[row] = self._last_seen[last]
+            self._codes[row] = self._codes[last]
+            self._rows[int(self._ids[row])] = row
+        self._names.pop()
+        self._size = last
+        return name
+
+    def touch(self, face_id, timestamp):
+        self._last_seen[self._rows[face_id]] = timestamp
 
 class FaceStorage():
     """ 
-    Stores known faces information in the following format:
-    face_encodings_metadata = {serialized_face_encoding : {'Name': name, 'Last_time_seen': last_time_seen}
+    Stores known faces information in an IdentityTable, every face is referred to by its integer identity ID.
+    The metadata of a face is exposed in the following format:
+    {'Name': name, 'Last_time_seen': last_time_seen, 'Code': code}
     
-    Faces are stored unserialized in an additional list "face_encodings" to improve performance when comparing faces.
+    Keeping the encodings in one contiguous matrix allows us to match all the faces of a frame with a single distance-matrix computation.
+    Large datasets can additionally be searched through an approximate nearest-neighbor index (see face_index.IVFIndex),
+    in which case only the candidates returned by the index are compared exactly. The index is built and rebuilt on a
+    background thread, faces are matched with the previous index (or a linear scan) until the new one is swapped in.
     """
 
-    def __init__(self, init_from_cache, cache_path, cache_file_name, expiration_time):
-        self.face_encodings_metadata = {}
-        self.face_encodings = []
+    match_code = -1 # Code reported for the faces of this storage, overridden by the subclasses
+
+    def __init__(self, init_from_cache, cache_path, cache_file_name, expiration_time, tolerance=DEFAULT_TOLERANCE, index=None):
+        self.identities = IdentityTable()
+        self.lock = ReadWriteLock() # Matching takes the read lock, every change to the faces takes the write lock
+        self.index = index
+        self.index_build_thread = None
+        self.index_changes = None # Changes of the rows made while an index is being built, replayed onto it before the swap
+        self.tolerance = tolerance
         self.cache_path = cache_path
         self.cache_file_name = cache_file_name
+        self.cache = FaceCache(cache_path, os.path.splitext(cache_file_name)[0])
         if init_from_cache:
             self.load_cache()
         self.expiration_time = expiration_time
 
-    def update_face_encodings(self, face_encodings):
-        self.face_encodings = face_encodings
+    def __len__(self):
+        return len(self.identities)
 
-    def serialize_face_encoding(self, face_encoding):
-        return json.dumps(face_encoding.tolist())
-    
     def deserialize_face_encoding(self, serialized_face_encoding):
         return np.array(json.loads(serialized_face_encoding))
 
-    def add_face_to_dataset(self, name, face_encoding):
-        """ Adds a face to the dataset """
-        serialized_face_encoding = self.serialize_face_encoding(face_encoding)
-        self.face_encodings_metadata[serialized_face_encoding] = {'Name': name, 'Last_time_seen': datetime.now()}
-        self.face_encodings.append(face_encoding)
-
-    def remove_from_array(self, base_array, target_array):
-        for index in range(len(base_array)):
-            if np.array_equal(base_array[index], target_array):
-                return np.delete(base_array, index, axis=0).tolist()
-        raise ValueError('remove_from_array(array, x): x not in array')
-
-    def remove_face_from_dataset(self, serialized_face_encoding):
-        """ Removes a face from the dataset """
-        deserialized_face_encoding = self.deserialize_face_encoding(serialized_face_encoding)
-        self.update_face_encodings(self.remove_from_array(self.face_encodings, deserialized_face_encoding))
-
-        face_name = self.face_encodings_metadata[serialized_face_encoding]['Name']
-        print(f"{face_name}'s face was found, but it has expired. Removing from dataset.")
-        _ = self.face_encodings_metadata.pop(serialized_face_encoding)
-        # try:
-        
-        # except Exception as e:
-        #     print("Removing face from dataset failed. Face not found in dataset.")
-        #     print("Continuing with the rest of the program.") 
-        #     raise Exception(e)
-        # else:
-        #     _ = self.face_encodings_metadata.pop(serialized_face_encoding)
-
-    def get_face_metadata_from_encoding(self, face_encoding):
-        """ Returns the metadata of a face given its encoding """
-        serialized_face_encoding = self.serialize_face_encoding(face_encoding)
-        return self.face_encodings_metadata[serialized_face_encoding]
-
-    def update_last_time_seen(self, serialized_face_encoding):
+    def add_face_to_dataset(self, name, face_encoding, last_time_seen=None, code=None):
+        """ Adds a face to the dataset and returns its identity ID """
+        last_time_seen = last_time_seen.timestamp() if last_time_seen else time.time()
+        code = self.match_code if code is None else code
+        with self.lock.write():
+            face_id = self.identities.add(name, face_encoding, last_time_seen, code)
+            row = self.identities.row_of(face_id)
+            self.cache.record_add(face_id, name, self.identities.encodings[row], last_time_seen, code)
+            self.update_index_rows('add_many', [row], self.identities.encodings[[row]])
+        return face_id
+
+    def add_faces_to_dataset(self, names, face_encodings, last_time_seen=None, code=None):
+        """ Adds many faces to the dataset in one batch and returns their identity IDs """
+        last_time_seen = last_time_seen.timestamp() if last_time_seen else time.time()
+        code = self.match_code if code is None else code
+        with self.lock.write():
+            first_row = len(self.identities)
+            face_ids = self.identities.add_many(names, np.asarray(face_encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE), last_time_seen, code)
+            rows = np.arange(first_row, len(self.identities))
+            for face_id, name, row in zip(face_ids.tolist(), names, rows.tolist()):
+                self.cache.record_add(face_id, name, self.identities.encodings[row], last_time_seen, code)
+            self.update_index_rows('add_many', rows, self.identities.encodings[rows])
+        return face_ids
+
+    def remove_face_from_dataset(self, face_id):
+        """ Removes a face from the dataset and returns its name """
+        with self.lock.write():
+            if face_id not in self.identities:
+                raise ValueError(f'remove_face_from_dataset(face_id): face {face_id} not in dataset')
+            row = self.identities.row_of(face_id)
+            face_name = self.identities.remove(face_id)
+            self.cache.record_remove(face_id)
+            self.update_index_rows('remove', row)
+            # The last face of the table was moved into the freed row
+            if row < len(self.identities):
+                self.update_index_rows('move', len(self.identities), row)
+        return face_name
+
+    def remove_faces_named(self, name):
+        """ Removes every face of a person, returns the number of faces removed """
+        with self.lock.write():
+            face_ids = [face_id for face_id, face_name in zip(self.identities.ids.tolist(), self.identities.names) if face_name == name]
+            for face_id in face_ids:
+                self.remove_face_from_dataset(face_id)
+        return len(face_ids)
+
+    def get_face_metadata(self, face_id):
+        """ Returns the metadata of a face given its identity ID """
+        return {'Name': self.identities.name_of(face_id),
+                'Last_time_seen': datetime.fromtimestamp(self.identities.last_seen_of(face_id)),
+                'Code': self.identities.code_of(face_id)}
+
+    def update_last_time_seen(self, face_id):
         """ Updates the last time a face was seen """
-        self.face_encodings_metadata[serialized_face_encoding]['Last_time_seen'] = datetime.now()
+        last_time_seen = time.time()
+        with self.lock.write():
+            self.identities.touch(face_id, last_time_seen)
+            self.cache.record_touch(face_id, last_time_seen)
 
-    def get_time_since_last_seen(self, serialized_face_encoding):
+    def get_time_since_last_seen(self, face_id):
         """ Returns the time since a face was last seen """
-        last_time_seen = self.face_encodings_metadata[serialized_face_encoding]['Last_time_seen']
-        time_difference = datetime.now() - last_time_seen
-        return time_difference
+        return timedelta(seconds=time.time() - self.identities.last_seen_of(face_id))
     
-    def is_face_expired(self, serialized_face_encoding):
+    def is_face_expired(self, face_id):
         """ Checks if a face is still valid """
-        time_since_last_seen = self.get_time_since_last_seen(serialized_face_encoding)
+        time_since_last_seen = self.get_time_since_last_seen(face_id)
         # If the face has not been seen for more than the expiration time (hours) remove it from the database
-        return time_since_last_seen.seconds > self.expiration_time * 3600
+        return time_since_last_seen.total_seconds() > self.expiration_time * 3600
+
+    def compute_face_distances(self, face_encodings, rows=None):
+        """ Returns the (len(face_encodings), N) matrix of euclidean distances to every stored face (or to the given rows only) """
+        queries = np.asarray(face_encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        encodings, squared_norms = self.identities.encodings, self.identities.squared_norms
+        if rows is not None:
+            encodings, squared_norms = encodings[rows], squared_norms[rows]
+        # ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b, so the whole matrix costs a single matrix product
+        squared_distances = np.einsum('ij,ij->i', queries, queries)[:, np.newaxis] + squared_norms[np.newaxis, :]
+        # Multiplying in this order walks the large row-major matrix contiguously, which is much faster than queries @ encodings.T
+        squared_distances -= 2 * (encodings @ queries.T).T
+        return np.sqrt(np.maximum(squared_distances, 0, out=squared_distances), out=squared_distances)
+
+    def index_needs_build(self):
+        if self.index.is_trained:
+            return len(self) >= 2 * self.index.trained_size
+        return len(self) >= self.index.min_training_size()
+
+    def update_index_rows(self, operation, *args):
+        """ Applies a change of the rows (an IVFIndex method and its arguments) to the index and to the one being built """
+        if self.index is not None and self.index.is_trained:
+            getattr(self.index, operation)(*args)
+        if self.index_changes is not None:
+            self.index_changes.append((operation, args))
+
+    def update_index(self):
+        """ Starts building the index once the dataset is large enough, and rebuilding it when the dataset has doubled since training """
+        if self.index is None or self.index_build_thread is not None or not self.index_needs_build():
+            return
+        with self.lock.write():
+            # Another thread may have started it while we were waiting for the lock
+            if self.index_build_thread is None and self.index_needs_build():
+                self.index_build_thread = threading.Thread(target=self.build_index, daemon=True)
+                self.index_build_thread.start()
+
+    def build_index(self):
+        """ Builds a new index from a copy of the encodings without holding the lock, then swaps it in """
+        try:
+            with self.lock.read():
+                encodings = np.array(self.identities.encodings)
+                self.index_changes = []
+            print(f"Building the nearest-neighbor index over {len(encodings)} faces")
+            index = self.index.untrained_copy()
+            index.build(encodings)
+            with self.lock.write():
+                # Catch up with the faces added and removed during the build
+                for operation, args in self.index_changes:
+                    getattr(index, operation)(*args)
+                self.index = index
+        finally:
+            with self.lock.write():
+                self.index_changes = None
+                self.index_build_thread = None
+
+    def find_nearest_faces(self, face_encodings):
+        """ Returns the rows of the nearest stored faces and their distances, one per face encoding """
+        if self.index is None or not self.index.is_trained:
+            distances = self.compute_face_distances(face_encodings)
+            nearest_rows = distances.argmin(axis=1)
+            return nearest_rows, distances[np.arange(len(nearest_rows)), nearest_rows]
+
+        # Re-rank the candidates of the index exactly
+        nearest_rows = np.full(len(face_encodings), -1, dtype=np.int64)
+        nearest_distances = np.full(len(face_encodings), np.inf, dtype=np.float32)
+        for i, (face_encoding, candidate_rows) in enumerate(zip(face_encodings, self.index.search(face_encodings))):
+            if len(candidate_rows) == 0:
+                continue
+            distances = self.compute_face_distances(face_encoding, candidate_rows)[0]
+            nearest = distances.argmin()
+            nearest_rows[i], nearest_distances[i] = candidate_rows[nearest], distances[nearest]
+        return nearest_rows, nearest_distances
+
+    def retrieve_metadata_of_nearest_matches(self, face_encodings):
+        """ 
+        Returns, for every face encoding, the metadata of its nearest match in the dataset (or None if there is no match
+        within tolerance). The returned metadata is a copy extended with the 'Face_id' and 'Distance' of the match.
+        """
+        results = [None] * len(face_encodings)
+        if len(face_encodings) == 0 or len(self) == 0:
+            return results
+
+        self.update_index()
+        with self.lock.read():
+            if len(self) == 0:
+                return results
+            nearest_rows, nearest_distances = self.find_nearest_faces(face_encodings)
+            for i, (row, distance) in enumerate(zip(nearest_rows, nearest_distances)):
+                if distance <= self.tolerance:
+                    face_id = int(self.identities.ids[row])
+                    results[i] = dict(self.get_face_metadata(face_id), Face_id=face_id, Distance=float(distance))
+        return results
     
     def retrieve_metadata_of_nearest_match(self, face_encoding):
         """ Returns the nearest match to a face from the dataset """
-        result = None
-        matches = face_recognition.compare_faces(self.face_encodings, face_encoding)
-        if True in matches:
-            matched_face_encoding = self.face_encodings[matches.index(True)]
-            result = self.get_face_metadata_from_encoding(matched_face_encoding)
-        return result
+        return self.retrieve_metadata_of_nearest_matches([face_encoding])[0]
     
     def save_cache(self):
-        """ Saves the known faces to a pickle file """
-        # Create folder if it doesn't exist
-        if not os.path.exists(self.cache_path):
-            os.makedirs(self.cache_path)
-
-        with open(f"{self.cache_path}/{self.cache_file_name}", 'wb') as f:
-            pkl.dump(self.face_encodings_metadata, f)
-            pkl.dump(self.face_encodings, f)
+        """ Saves the changes made to the known faces since the last save """
+        with self.lock.write():
+            self.cache.save(self.identities)
 
     def load_cache(self):
-        """ Reads the known faces from a pickle file """
+        """ Reads the known faces from the cache, migrating the pickle file used by previous versions if needed """
         print("Loading cache from file")
-        if os.path.exists(f"{self.cache_path}/{self.cache_file_name}"):
-            with open(f"{self.cache_path}/{self.cache_file_name}", 'rb') as f:
-                self.face_encodings_metadata = pkl.load(f)
-                self.face_encodings = pkl.load(f)
+        legacy_cache_file = f"{self.cache_path}/{self.cache_file_name}"
+        if self.cache.exists():
+            self.cache.load(self.identities)
+        elif os.path.exists(legacy_cache_file):
+            print(f"Migrating {legacy_cache_file} to the binary cache format")
+            self.load_legacy_cache(legacy_cache_file)
+            self.cache.compact(self.identities)
+            os.replace(legacy_cache_file, f"{legacy_cache_file}.migrated")
         else:
             print("Cache file not found. Starting with an empty database.")
 
+    def load_legacy_cache(self, cache_file):
+        """ Reads the known faces from a pickle file: metadata keyed by serialized encoding, followed by the list of encodings """
+        with open(cache_file, 'rb') as f:
+            face_encodings_metadata = pkl.load(f)
+        for serialized_face_encoding, metadata in face_encodings_metadata.items():
+            self.add_face_to_dataset(metadata['Name'],
+                                     self.deserialize_face_encoding(serialized_face_encoding),
+                                     last_time_seen=metadata['Last_time_seen'])
+
 class EphemeralFaceStorage(FaceStorage):
     """ Meant to handle storage and retrieval of faces viewed over the past X hours (X=expiration_time).
-     Clean out expired faces from the dataset by running .clean() """
+     Clean out expired faces from the dataset by running .clean() 
+     
+     A min-heap of (last_time_seen, face_id) entries lets .clean() only look at the faces that have actually expired.
+     Touching a face pushes a new entry and leaves the old one in the heap, stale entries are skipped when popped. """
+
+    match_code = 0 # Code 0 means the face has appeared recently
 
     def __init__(self, init_from_cache, cache_path, expiration_time):
         """ Expiration time is in hours """
+        self.expiry_heap = []
         super(EphemeralFaceStorage, self).__init__(
             init_from_cache=init_from_cache,
             cache_path=cache_path,
             cache_file_name='temp.cache', # 'temp.cache' is used to distinguish it from 'permanent.cache
             expiration_time=expiration_time,
             )
+        self.rebuild_expiry_heap()
+
+    def rebuild_expiry_heap(self):
+        """ Rebuilds the heap from the table, dropping the stale entries """
+        self.expiry_heap = list(zip(self.identities.last_seen.tolist(), self.identities.ids.tolist()))
+        heapq.heapify(self.expiry_heap)
+
+    def add_face_to_dataset(self, name, face_encoding, last_time_seen=None, code=None):
+        with self.lock.write():
+            face_id = super(EphemeralFaceStorage, self).add_face_to_dataset(name, face_encoding, last_time_seen=last_time_seen, code=code)
+            heapq.heappush(self.expiry_heap, (self.identities.last_seen_of(face_id), face_id))
+        return face_id
+
+    def add_faces_to_dataset(self, names, face_encodings, last_time_seen=None, code=None):
+        with self.lock.write():
+            face_ids = super(EphemeralFaceStorage, self).add_faces_to_dataset(names, face_encodings, last_time_seen=last_time_seen, code=code)
+            for face_id in face_ids.tolist():
+                heapq.heappush(self.expiry_heap, (self.identities.last_seen_of(face_id), face_id))
+        return face_ids
+
+    def update_last_time_seen(self, face_id):
+        with self.lock.write():
+            super(EphemeralFaceStorage, self).update_last_time_seen(face_id)
+            heapq.heappush(self.expiry_heap, (self.identities.last_seen_of(face_id), face_id))
     
-    def remove_face_if_expired(self, serialized_face_encoding):
+    def remove_face_if_expired(self, face_id):
         """ Removes a face if it has passed expiration time """
-        if self.is_face_expired(serialized_face_encoding):
-            print("Removing a face from ephemeral storage.")
-            self.remove_face_from_dataset(serialized_face_encoding)
+        with self.lock.write():
+            if self.is_face_expired(face_id):
+                face_name = self.remove_face_from_dataset(face_id)
+                print(f"{face_name}'s face has expired. Removing it from ephemeral storage.")
 
     def clean(self):
-        """ Removes all expired faces from the dataset """
-        for serialized_face_encoding in list(self.face_encodings_metadata.keys()):
-            self.remove_face_if_expired(serialized_face_encoding)
+        """ Removes all expired faces from the dataset, returns the number of faces removed """
+        expiration_timestamp = time.time() - self.expiration_time * 3600
+        removed_faces = 0
+        # Most calls have nothing to remove, they return without waiting for the write lock.
+        # The top entry is read once, another stream may pop it between two reads.
+        top = self.expiry_heap[:1]
+        if not top or top[0][0] >= expiration_timestamp:
+            return removed_faces
+        with self.lock.write():
+            while self.expiry_heap and self.expiry_heap[0][0] < expiration_timestamp:
+                last_time_seen, face_id = heapq.heappop(self.expiry_heap)
+                # Skip the entries of faces that were removed or seen again since the entry was pushed
+                if face_id in self.identities and self.identities.last_seen_of(face_id) == last_time_seen:
+                    face_name = self.remove_face_from_dataset(face_id)
+                    print(f"{face_name}'s face has expired. Removing it from ephemeral storage.")
+                    removed_faces += 1
+
+            # Keep the stale entries from piling up when the same faces are touched over and over
+            if len(self.expiry_heap) > 2 * len(self) + 64:
+                self.rebuild_expiry_heap()
+        return removed_faces
 
 class PermanentFaceStorage(FaceStorage):
-    """ Handles storage and retrieval of known faces """
-    def __init__(self, init_from_cache, cache_path, expiration_time):
+    """ Handles storage and retrieval of known faces.
+    Set ann_lists to search the faces through an approximate nearest-neighbor index with ann_lists clusters,
+    ann_probes clusters are scanned per face (more probes = better recall, slower). """
+
+    match_code = 1 # Code 1 means the face hasn't appeared recently but is known
+
+    def __init__(self, init_from_cache, cache_path, expiration_time, ann_lists=None, ann_probes=16):
         super(PermanentFaceStorage, self).__init__(
             init_from_cache=init_from_cache,
             cache_path=cache_path,
             cache_file_name='permanent.cache', # 'permanent.cache' is used to distinguish it from 'temp.cache
             expiration_time=expiration_time,
+            index=IVFIndex(n_lists=ann_lists, n_probe=ann_probes) if ann_lists else None,
             )
     
 class FaceRecognizer():
@@ -153,51 +485,95 @@ class FaceRecognizer():
     2. An EphemeralFaceStorage object used to store and retrieve faces that have appeared recently
 
     The distinction between these two types of storage allows us to handle faces in a flexible manner
+
+    Stage timings, face counters and storage sizes are recorded in the metrics registry given at construction
+    (a no-op registry by default).
+
+    The detector upsampling, landmark model ('large' or 'small') and encoding jitters are attributes, so they can be tuned
+    while running (see quality.LatencyController).
     
     """
 
     def __init__(self,
                  init_from_cache,
                  cache_path,
-                 expiration_time):
+                 expiration_time,
+                 ann_lists=None,
+                 ann_probes=16,
+                 metrics=None):
+        self.metrics = metrics or NullMetrics()
+        self.number_of_times_to_upsample = 1
+        self.landmark_model = DEFAULT_LANDMARK_MODEL
+        self.num_jitters = 1
         self.ephemeral_storage = EphemeralFaceStorage(init_from_cache=init_from_cache, 
                                               cache_path=cache_path,
                                               expiration_time=expiration_time)
         self.permanent_storage = PermanentFaceStorage(init_from_cache=init_from_cache, 
                                               cache_path=cache_path,
-                                              expiration_time=expiration_time)
+                                              expiration_time=expiration_time,
+                                              ann_lists=ann_lists,
+                                              ann_probes=ann_probes)
 
     def save_cache(self):
-        """ Saves the known faces to a pickle file """
+        """ Saves the known faces to the cache """
         print("Saving cache to file")
         self.permanent_storage.save_cache()
         self.ephemeral_storage.save_cache()
 
+    def forget(self, name):
+        """ Removes every face of a person from both storages, returns the number of faces removed """
+        removed_faces = self.permanent_storage.remove_faces_named(name) + self.ephemeral_storage.remove_faces_named(name)
+        print(f"Removed {removed_faces} faces of {name} from the database")
+        return removed_faces
+
+    def detect_face_locations(self, frame, regions=None):
+        # Find all the faces in the current frame of video, or only in the given (top, right, bottom, left) regions of it
+        with self.metrics.time('detect_faces'):
+            if regions is None:
+                face_locations = face_recognition.face_locations(frame, number_of_times_to_upsample=self.number_of_times_to_upsample)
+            else:
+                face_locations = []
+                for top, right, bottom, left in regions:
+                    region = np.ascontiguousarray(frame[top:bottom, left:right])
+                    # Map the boxes back to the coordinates of the frame
+                    face_locations.extend((face_top + top, face_right + left, face_bottom + top, face_left + left)
+                                          for face_top, face_right, face_bottom, face_left
+                                          in face_recognition.face_locations(region, number_of_times_to_upsample=self.number_of_times_to_upsample))
+        self.metrics.increment('faces_detected', len(face_locations))
+        return face_locations
+
+    def encode_faces(self, frame, face_locations):
+        # Compute the encodings of the faces found at the given locations
+        with self.metrics.time('encode_faces'):
+            return face_recognition.face_encodings(frame, face_locations, num_jitters=self.num_jitters, model=self.landmark_model)
+
     def detect_faces(self, frame):
         # Find all the faces and face encodings in the current frame of video
-        detected_face_locations = face_recognition.face_locations(frame)
-        detected_face_encodings = face_recognition.face_encodings(frame, detected_face_locations)
+        detected_face_locations = self.detect_face_locations(frame)
+        detected_face_encodings = self.encode_faces(frame, detected_face_locations)
         return detected_face_locations, detected_face_encodings
 
     def retrieve_metadata_from_faces(self, detected_face_encodings):
-        # Remove expired faces from ephemeral storage before retreiving metadata
-        self.ephemeral_storage.clean()
-
-        faces_metadata = []
-        for face_encoding in detected_face_encodings:
-            # See if the face appears in the ephemeral storage
-            metadata = self.ephemeral_storage.retrieve_metadata_of_nearest_match(face_encoding)
-            if metadata:
-                metadata["Code"] = 0 # Code 0 means the face has appeared recently
-                faces_metadata.append(metadata)
-            else:
-                # If the face does not appear in the ephemeral storage, check the permanent storage
-                metadata = self.permanent_storage.retrieve_metadata_of_nearest_match(face_encoding)
+        with self.metrics.time('retrieve_metadata_from_faces'):
+            # Remove expired faces from ephemeral storage before retreiving metadata
+            expired_faces = self.ephemeral_storage.clean()
+
+            # See if the faces appear in the ephemeral storage (Code 0), all faces of the frame are matched at once
+            faces_metadata = self.ephemeral_storage.retrieve_metadata_of_nearest_matches(detected_face_encodings)
+
+            # If a face does not appear in the ephemeral storage, check the permanent storage (Code 1)
+            missing_indices = [i for i, metadata in enumerate(faces_metadata) if metadata is None]
+            permanent_metadata = self.permanent_storage.retrieve_metadata_of_nearest_matches([detected_face_encodings[i] for i in missing_indices])
+            for i, metadata in zip(missing_indices, permanent_metadata):
                 if metadata:
-                    metadata["Code"] = 1 # Code 1 means the face hasn't appeared recently but is known
-                    faces_metadata.append(metadata)
+                    faces_metadata[i] = metadata
                 else:
                     # If the face does not appear in the permanent storage, it is a completely unknown face 
-                    faces_metadata.append({"Name": "Unknown", "Last_time_seen": None, "Code": -1}) # Code -1 means we should take actions to handle the unknown face
-        
-        return faces_metadata
\ No newline at end of file
+                    faces_metadata[i] = {"Name": "Unknown", "Last_time_seen": None, "Code": -1} # Code -1 means we should take actions to handle the unknown face
+
+        self.metrics.increment('faces_expired', expired_faces)
+        for metadata in faces_metadata:
+            self.metrics.increment('faces_matched', labels={'code': metadata['Code']})
+        self.metrics.set_gauge('gallery_size', len(self.ephemeral_storage), labels={'storage': 'ephemeral'})
+        self.metrics.set_gauge('gallery_size', len(self.permanent_storage), labels={'storage': 'permanent'})
+        return faces_metadata
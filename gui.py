@@ -1,4 +1,5 @@
 import cv2
+import numpy as np
 
 import tkinter as tk
 from tkinter import Label, Entry, Button
@@ -31,12 +32,11 @@ class DialogBoxHandler():
     def __init__(self):
         pass
     
-    def create_name_face_dialog(self, face_image):
+    def create_name_face_dialog(self, face_image, prompt_message="Unknown face detected. Please enter the name of the person:"):
         self.dialog_result = None
         window = tk.Tk()
         window.title("Unknown Face Detected")
 
-        prompt_message = "Unknown face detected. Please enter the name of the person:"
         prompt_label = Label(window, text=prompt_message, wraplength=300)
         prompt_label.pack()
 
@@ -71,6 +71,26 @@ class DialogBoxHandler():
         thread.start()
         return thread.join()
 
+    def review_unknown_faces(self, review_queue, on_reviewed, image_height=150):
+        """ Asks for the name of every pending cluster of unknown faces, one dialog at a time, and hands it to on_reviewed(cluster, name) """
+        while True:
+            cluster = review_queue.wait_next()
+            if cluster is None:
+                return
+            # Show the samples of the cluster side by side
+            face_images = [cv2.resize(face_image, (max(int(face_image.shape[1] * image_height / face_image.shape[0]), 1), image_height))
+                           for face_image in list(cluster.face_images) if face_image.size]
+            prompt_message = f"Unknown face seen {cluster.sightings} times. Please enter the name of the person:"
+            name = self.create_name_face_dialog(np.hstack(face_images), prompt_message) if face_images else None
+            on_reviewed(cluster, name or None)
+            review_queue.resolve(cluster)
+
+    def start_review_thread(self, review_queue, on_reviewed):
+        """ Reviews the unknown faces in the background, the video keeps streaming while a dialog is open """
+        thread = ReturnValueThread(target=self.review_unknown_faces, args=(review_queue, on_reviewed), daemon=True)
+        thread.start()
+        return thread
+
 class VideoHandler():
     """ Handles tasks related to streaming of videos and handling and modifying individual frames """
 
@@ -79,6 +99,10 @@ class VideoHandler():
         self.resize_factor = resize_factor
         self.scale_up_factor = 1/resize_factor # Factor needed to scale up the face boundary boxes to the original frame size
 
+    def set_resize_factor(self, resize_factor):
+        self.resize_factor = resize_factor
+        self.scale_up_factor = 1/resize_factor
+
     def is_camera_working(self):
         return self.video_capture.isOpened()
 
@@ -88,15 +112,17 @@ class VideoHandler():
         return ret, frame
     
     def process_frame(self, frame):
-        """ Processes the frame of the video """
+        """ Processes the frame of the video, returns it resized and in RGB order """
         # Resize frame of video to smaller size (default 1/4 size) for faster face recognition processing
-        return cv2.resize(frame, (0, 0), fx=self.resize_factor, fy=self.resize_factor)
+        small_frame = cv2.resize(frame, (0, 0), fx=self.resize_factor, fy=self.resize_factor)
+        # OpenCV frames are BGR, faces are encoded from RGB images everywhere (enrollment loads photos as RGB)
+        return cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB)
     
     def scale_up_boundary_box(self, face_location):
         """ Scales up a given boundary box to the original frame size """
         return tuple([int(x * self.scale_up_factor) for x in face_location])
     
-    def display_frame_with_faces(self, frame, face_locations, face_names):
+    def display_frame_with_faces(self, frame, face_locations, face_names, window_name='Video'):
 
         # Display the results
         for face_location, name in zip(face_locations, face_names):
@@ -112,7 +138,7 @@ class VideoHandler():
             cv2.putText(frame, name, (left + 6, bottom - 6), font, 1.0, (255, 255, 255), 1)
 
         # Display the resulting image
-        cv2.imshow('Video', frame)
+        cv2.imshow(window_name, frame)
 
     def picture_from_boundary_box(self, frame, face_location):
         """ Unpacks boundary box and returns the face image"""
@@ -0,0 +1,120 @@
+import cv2
+import json
+import os
+import sys
+from collections import deque
+import numpy as np
+
+from batch_recognizer import BatchFaceRecognizer
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+
+def iter_video_frames(video_path, start_frame=0, end_frame=None, frame_stride=1):
+    """ Yields (frame_number, timestamp_ms, frame) for the selected frames of a video file """
+    video_capture = cv2.VideoCapture(video_path)
+    if not video_capture.isOpened():
+        raise IOError(f"Could not open video file {video_path}")
+    try:
+        if start_frame:
+            video_capture.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+        frame_number = start_frame
+        while end_frame is None or frame_number < end_frame:
+            # Skipped frames are only grabbed, not decoded
+            if (frame_number - start_frame) % frame_stride:
+                if not video_capture.grab():
+                    break
+            else:
+                ret, frame = video_capture.read()
+                if not ret:
+                    break
+                yield frame_number, video_capture.get(cv2.CAP_PROP_POS_MSEC), frame
+            frame_number += 1
+    finally:
+        video_capture.release()
+
+def iter_image_directory_frames(directory, start_frame=0, end_frame=None, frame_stride=1):
+    """ Yields (frame_number, file_name, frame) for the selected images of a directory, in file name order """
+    file_names = sorted(file_name for file_name in os.listdir(directory) if file_name.lower().endswith(IMAGE_EXTENSIONS))
+    for frame_number in range(start_frame, len(file_names) if end_frame is None else min(end_frame, len(file_names)), frame_stride):
+        frame = cv2.imread(os.path.join(directory, file_names[frame_number]))
+        if frame is None:
+            print(f"Could not read {file_names[frame_number]}, skipping it", file=sys.stderr)
+            continue
+        yield frame_number, file_names[frame_number], frame
+
+def iter_raw_frames(stream, frame_size, start_frame=0, end_frame=None, frame_stride=1):
+    """ Yields (frame_number, None, frame) for raw BGR24 frames of frame_size=(width, height) read from a binary stream,
+    e.g. the output of ffmpeg -f rawvideo -pix_fmt bgr24 - """
+    width, height = frame_size
+    frame_bytes = width * height * 3
+    frame_number = 0
+    while end_frame is None or frame_number < end_frame:
+        buffer = stream.read(frame_bytes)
+        if len(buffer) < frame_bytes:
+            break
+        if frame_number >= start_frame and (frame_number - start_frame) % frame_stride == 0:
+            yield frame_number, None, np.frombuffer(buffer, dtype=np.uint8).reshape(height, width, 3)
+        frame_number += 1
+
+def iter_frames(source, start_frame=0, end_frame=None, frame_stride=1, frame_size=None):
+    """ Yields (frame_number, position, frame) from a video file, a directory of images or raw frames on stdin ('-') """
+    if source == '-':
+        if frame_size is None:
+            raise ValueError("The frame size is needed to read raw frames from stdin")
+        return iter_raw_frames(sys.stdin.buffer, frame_size, start_frame, end_frame, frame_stride)
+    if os.path.isdir(source):
+        return iter_image_directory_frames(source, start_frame, end_frame, frame_stride)
+    return iter_video_frames(source, start_frame, end_frame, frame_stride)
+
+def detect_faces_in_frames(face_recognizer, small_frames, batch_recognizer=None):
+    """ Yields (face_locations, face_encodings) for every frame, in the calling process or on a BatchFaceRecognizer """
+    if batch_recognizer is not None:
+        yield from batch_recognizer.detect_faces(small_frames)
+    else:
+        for small_frame in small_frames:
+            yield face_recognizer.detect_faces(small_frame)
+
+def recognize_frames(face_recognizer, frames, resize_factor=0.25, batch_recognizer=None):
+    """
+    Runs every (frame_number, position, frame) through the face recognizer and yields one result per frame:
+    {'frame': frame_number, 'position': timestamp in ms or file name, 'faces': [{'name', 'code', 'distance', 'box'}]}
+    Boxes are (top, right, bottom, left) in the coordinates of the original frame.
+    Frames are consumed lazily, so memory stays bounded whatever the length of the footage.
+    """
+    in_flight = deque() # (frame_number, position) of the frames handed to the detector and not yet reported
+
+    def small_frames():
+        for frame_number, position, frame in frames:
+            in_flight.append((frame_number, position))
+            # Faces are encoded from RGB images, like the enrolled photos
+            yield cv2.cvtColor(cv2.resize(frame, (0, 0), fx=resize_factor, fy=resize_factor), cv2.COLOR_BGR2RGB)
+
+    for face_locations, face_encodings in detect_faces_in_frames(face_recognizer, small_frames(), batch_recognizer):
+        frame_number, position = in_flight.popleft()
+        faces_metadata = face_recognizer.retrieve_metadata_from_faces(face_encodings)
+        faces = []
+        for face_location, metadata in zip(face_locations, faces_metadata):
+            faces.append({'name': metadata['Name'],
+                          'code': metadata['Code'],
+                          'distance': metadata.get('Distance'),
+                          'box': [int(x / resize_factor) for x in face_location]})
+        yield {'frame': frame_number, 'position': position, 'faces': faces}
+
+def write_jsonl(results, output):
+    for result in results:
+        output.write(json.dumps(result) + '\n')
+
+def run_headless(face_recognizer, source, output, resize_factor=0.25, start_frame=0, end_frame=None,
+                 frame_stride=1, frame_size=None, workers=1):
+    """ Recognizes the faces of a video file, image directory or stdin and writes the results to output as JSONL """
+    frames = iter_frames(source, start_frame, end_frame, frame_stride, frame_size)
+    # The workers detect and encode with the settings of the face recognizer, so the results don't depend on the number of workers
+    batch_recognizer = BatchFaceRecognizer(workers=workers,
+                                           number_of_times_to_upsample=face_recognizer.number_of_times_to_upsample,
+                                           landmark_model=face_recognizer.landmark_model,
+                                           num_jitters=face_recognizer.num_jitters) if workers > 1 else None
+    try:
+        write_jsonl(recognize_frames(face_recognizer, frames, resize_factor, batch_recognizer), output)
+    finally:
+        if batch_recognizer is not None:
+            batch_recognizer.close()
@@ -0,0 +1,54 @@
+import threading
+from contextlib import contextmanager
+
+class ReadWriteLock():
+    """
+    Lets many readers hold the lock at once, writers get it exclusively.
+    Waiting writers block new readers, so a steady stream of matching requests cannot starve an enrollment.
+    The writer may re-acquire the lock (for reading or writing) from its own thread, e.g. when a locked method calls another one.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.waiting_writers = 0
+        self.writer = None # Thread holding the write lock
+        self.writer_depth = 0
+
+    @contextmanager
+    def read(self):
+        current_thread = threading.get_ident()
+        if self.writer == current_thread:
+            yield
+            return
+        with self.condition:
+            self.condition.wait_for(lambda: self.writer is None and not self.waiting_writers)
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if not self.readers:
+                    self.condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        current_thread = threading.get_ident()
+        with self.condition:
+            if self.writer != current_thread:
+                self.waiting_writers += 1
+                try:
+                    self.condition.wait_for(lambda: self.writer is None and not self.readers)
+                finally:
+                    self.waiting_writers -= 1
+                self.writer = current_thread
+            self.writer_depth += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writer_depth -= 1
+                if not self.writer_depth:
+                    self.writer = None
+                    self.condition.notify_all()
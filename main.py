@@ -1,27 +1,82 @@
 from face_recognizer import FaceRecognizer
 from gui import GUIHandler
+from pipeline import DroppingQueue, LatestValue, PipelineClosed
+from tracker import FaceTracker
+from headless import run_headless
+from enroll import enroll_directory
+from multi_stream import MultiStreamRunner
+from review_queue import UnknownFaceQueue
+from motion import MotionGate
+from server import RecognitionServer
+from quality import LatencyController
+from metrics import Metrics, NullMetrics, JsonLogSink, PrometheusSink, ProfilerSink
 import argparse
+import contextlib
+import sys
+import threading
+import time
 import cv2
 
 class RecognizerStream():
-    def __init__(self, camera_index, resize_factor, init_from_cache, cache_path, expiration_time):
+    def __init__(self, camera_index, resize_factor, init_from_cache, cache_path, expiration_time, ann_lists=None, ann_probes=16,
+                 detection_interval=2, refresh_interval=30, use_optical_flow=False, use_motion_gate=False, motion_threshold=25, latency_budget=None, metrics=None):
+        self.metrics = metrics or NullMetrics()
         
         self.gui_handler = GUIHandler(camera_index=camera_index, 
                                       resize_factor=resize_factor)
         self.face_recognizer = FaceRecognizer(init_from_cache=init_from_cache,
                                                       cache_path=cache_path,
-                                                      expiration_time=expiration_time)
-        
-        self.processing_unknown_face = False # Flag to avoid a prompt for another unknown face when we are already processing one
+                                                      expiration_time=expiration_time,
+                                                      ann_lists=ann_lists,
+                                                      ann_probes=ann_probes,
+                                                      metrics=self.metrics)
+        # Decides on which frames faces are detected, encoded and matched
+        self.face_tracker = FaceTracker(self.face_recognizer,
+                                        detection_interval=detection_interval,
+                                        refresh_interval=refresh_interval,
+                                        use_optical_flow=use_optical_flow,
+                                        motion_gate=MotionGate(threshold=motion_threshold) if use_motion_gate else None)
+
+        # Adjusts the resize factor and the detection settings to keep the processing of a frame within latency_budget seconds
+        self.latency_controller = LatencyController(latency_budget, resize_factor=resize_factor) if latency_budget else None
+        if self.latency_controller is not None:
+            self.apply_quality_level()
+
+        # Unknown faces wait here, clustered by person, until they are named in a dialog running next to the video
+        self.review_queue = UnknownFaceQueue()
+        self.review_thread = None
+
+    def start_review(self):
+        self.review_thread = self.gui_handler.start_review_thread(self.review_queue, self.add_cluster_to_storages)
 
-    def add_face_to_permanent_storage(self, name, face_encoding):
-        # Add the unknown face to the database
+    def add_cluster_to_storages(self, cluster, name):
+        # The samples of the cluster are added in one batch
+        face_encodings = list(cluster.encodings)
+        # Add the faces to ephemeral storage, named or not, so the person is not queued for review again
+        self.face_recognizer.ephemeral_storage.add_faces_to_dataset([name] * len(face_encodings), face_encodings)
+        # Add the named faces to the database
         if name:
             print(f"Adding {name} to the database")
-            self.face_recognizer.permanent_storage.add_face_to_dataset(name, face_encoding)
+            self.face_recognizer.permanent_storage.add_faces_to_dataset([name] * len(face_encodings), face_encodings)
         else:
             print("Unknown face not added to the database")
-        self.processing_unknown_face = False
+
+    def apply_quality_level(self):
+        resize_factor = self.latency_controller.level.resize_factor
+        if resize_factor != self.gui_handler.resize_factor:
+            # The boxes of the tracks are in the coordinates of the resized frames
+            self.face_tracker.rescale(resize_factor / self.gui_handler.resize_factor)
+            self.gui_handler.set_resize_factor(resize_factor)
+        self.metrics.set_gauge('quality_level', self.latency_controller.level_index)
+
+    def adapt_quality(self, frame_time):
+        # Only the frames where faces were detected tell what the current settings cost
+        if self.face_tracker.ran_detection and self.latency_controller.observe(frame_time):
+            self.apply_quality_level()
+        face_locations = [track.face_location for track in self.face_tracker.visible_tracks()]
+        (self.face_recognizer.number_of_times_to_upsample,
+         self.face_recognizer.landmark_model,
+         self.face_recognizer.num_jitters) = self.latency_controller.detection_settings(face_locations)
 
     def handle_faces(self, frame, faces_metadata, face_locations, face_encodings):
         # Handle the faces case by case
@@ -32,14 +87,11 @@ class RecognizerStream():
                 self.handle_known_face()
 
     def handle_unknown_face(self, frame, face_location, face_encoding):
-        # Prompt user to add it to the permanent database
-        if not self.processing_unknown_face:
-            self.processing_unknown_face = True
-            name = self.gui_handler.prompt_for_name_of_unknown_face(frame, face_location)
-
-            # Add face to ephemeral storage
-            self.face_recognizer.ephemeral_storage.add_face_to_dataset(name, face_encoding)
-            self.add_face_to_permanent_storage(name, face_encoding)
+        # Queue the face for the user to add it to the permanent database, without pausing the video
+        face_image = self.gui_handler.picture_from_boundary_box(frame, self.gui_handler.scale_up_boundary_box(face_location))
+        # Copy the face, the frame is drawn on afterwards
+        self.review_queue.add(face_encoding, face_image.copy())
+        self.metrics.set_gauge('pending_reviews', len(self.review_queue))
 
     def handle_known_face(self):
         # If a face is known, do something, for example, greet the person, play some music or some sound effect
@@ -54,28 +106,35 @@ class RecognizerStream():
         return False
 
     def stream_video(self):
-        process_this_frame = True # process_this_frame will be used to skip everything other frame -> Less smooth but faster
-
+        self.start_review()
         while True:
-            ret, frame = self.gui_handler.get_frame()
-
-            if process_this_frame:
+            with self.metrics.time('get_frame'):
+                ret, frame = self.gui_handler.get_frame()
+            frame_start = time.perf_counter()
+            with self.metrics.time('process_frame'):
                 rgb_small_frame = self.gui_handler.process_frame(frame)
 
-                # Check if any faces are detected
-                face_locations, face_encodings = self.face_recognizer.detect_faces(rgb_small_frame)
-
-                # Cross reference these faces with the database
-                faces_metadata = self.face_recognizer.retrieve_metadata_from_faces(face_encodings)
+            # Follow the faces across frames, they are only detected, encoded and cross referenced with the database when needed
+            tracks = self.face_tracker.process_frame(rgb_small_frame)
 
-                # Handle the faces case by case
-                self.handle_faces(frame, faces_metadata, face_locations, face_encodings)
+            # Handle the faces whose identity was just computed case by case
+            fresh_tracks = [track for track in tracks if track.is_fresh]
+            with self.metrics.time('handle_faces'):
+                self.handle_faces(frame,
+                                  [track.metadata for track in fresh_tracks],
+                                  [track.face_location for track in fresh_tracks],
+                                  [track.face_encoding for track in fresh_tracks])
+            frame_time = time.perf_counter() - frame_start
 
-            process_this_frame = not process_this_frame
-            face_names = [metadata['Name'] for metadata in faces_metadata]
+            face_locations = [track.face_location for track in tracks]
+            face_names = [track.metadata['Name'] for track in tracks]
 
             # Display the results
-            self.gui_handler.display_frame_with_faces(frame, face_locations, face_names)
+            with self.metrics.time('display_frame_with_faces'):
+                self.gui_handler.display_frame_with_faces(frame, face_locations, face_names)
+
+            if self.latency_controller is not None:
+                self.adapt_quality(frame_time)
 
             key = cv2.waitKey(1) & 0xFF
 
@@ -83,23 +142,340 @@ class RecognizerStream():
                 break
 
         # Release handle to the webcam
+        self.review_queue.close()
         self.gui_handler.video_capture.release()
         cv2.destroyAllWindows()
 
+class PipelinedRecognizerStream(RecognizerStream):
+    """
+    Runs the recognition loop as a pipeline of stages connected by bounded queues:
+    1. A capture thread reading frames from the camera
+    2. A pool of detection workers finding and encoding the faces (dlib releases the GIL, so they run in parallel)
+    3. A matcher thread cross referencing the faces with the database and queueing the unknown ones for review
+    4. The render stage on the main thread, displaying every captured frame with the most recent recognition results
+
+    Queues drop their oldest frame when full, so the display keeps up with the camera while recognition runs as fast as the cores allow.
+    """
+
+    def __init__(self, *args, detection_workers=2, **kwargs):
+        super(PipelinedRecognizerStream, self).__init__(*args, **kwargs)
+        self.detection_workers = detection_workers
+        self.captured_frames = LatestValue()
+        self.detection_queue = DroppingQueue(maxsize=detection_workers,
+                                             on_drop=lambda: self.metrics.increment('frames_dropped', labels={'stage': 'detection'}))
+        self.matching_queue = DroppingQueue(maxsize=detection_workers,
+                                            on_drop=lambda: self.metrics.increment('frames_dropped', labels={'stage': 'matching'}))
+        self.recognized_faces = LatestValue(([], []))
+        self.save_requested = threading.Event()
+        self.threads = []
+
+    def run_capture(self):
+        frame_number = 0
+        while not self.captured_frames.closed:
+            with self.metrics.time('get_frame'):
+                ret, frame = self.gui_handler.get_frame()
+            if not ret:
+                print("Could not read a frame from the camera, stopping the stream")
+                break
+            self.captured_frames.set((frame_number, frame))
+            self.detection_queue.put((frame_number, frame))
+            frame_number += 1
+        self.close_pipeline()
+
+    def run_detection_worker(self):
+        try:
+            while True:
+                frame_number, frame = self.detection_queue.get()
+                with self.metrics.time('process_frame'):
+                    small_frame = self.gui_handler.process_frame(frame)
+                face_locations, face_encodings = self.face_recognizer.detect_faces(small_frame)
+                self.matching_queue.put((frame_number, frame, face_locations, face_encodings))
+        except PipelineClosed:
+            pass
+
+    def run_matcher(self):
+        last_frame_number = -1
+        try:
+            while True:
+                frame_number, frame, face_locations, face_encodings = self.matching_queue.get()
+                if self.save_requested.is_set():
+                    self.save_requested.clear()
+                    self.face_recognizer.save_cache()
+                    print("Current cache of faces saved to file")
+
+                # Workers can finish out of order, results older than the ones displayed are dropped
+                if frame_number < last_frame_number:
+                    continue
+                last_frame_number = frame_number
+
+                faces_metadata = self.face_recognizer.retrieve_metadata_from_faces(face_encodings)
+                self.recognized_faces.set((face_locations, [metadata['Name'] for metadata in faces_metadata]))
+                with self.metrics.time('handle_faces'):
+                    self.handle_faces(frame, faces_metadata, face_locations, face_encodings)
+        except PipelineClosed:
+            pass
+
+    def handle_key_press(self, key):
+        if key == ord('s'):
+            # The matcher owns the storages, let it save them between two frames
+            self.save_requested.set()
+            return False
+        return super(PipelinedRecognizerStream, self).handle_key_press(key)
+
+    def close_pipeline(self):
+        self.captured_frames.close()
+        self.detection_queue.close()
+        self.matching_queue.close()
+
+    def stream_video(self):
+        self.start_review()
+        targets = [self.run_capture, self.run_matcher] + [self.run_detection_worker] * self.detection_workers
+        self.threads = [threading.Thread(target=target, daemon=True) for target in targets]
+        for thread in self.threads:
+            thread.start()
+
+        version = 0
+        try:
+            while True:
+                version, captured_frame = self.captured_frames.wait_newer(version, timeout=0.1)
+                if captured_frame is not None:
+                    _, frame = captured_frame
+                    face_locations, face_names = self.recognized_faces.get()[1]
+                    # Draw on a copy, the detection workers may still be reading the captured frame
+                    with self.metrics.time('display_frame_with_faces'):
+                        self.gui_handler.display_frame_with_faces(frame.copy(), face_locations, face_names)
+
+                key = cv2.waitKey(1) & 0xFF
+                if self.handle_key_press(key):
+                    break
+        except PipelineClosed:
+            pass
+
+        self.close_pipeline()
+        for thread in self.threads:
+            thread.join(timeout=1)
+
+        # Release handle to the webcam
+        self.review_queue.close()
+        self.gui_handler.video_capture.release()
+        cv2.destroyAllWindows()
+
+def create_metrics(args):
+    """ Returns the metrics registry and the sinks exporting it, instrumentation is disabled when no sink is requested """
+    sinks = []
+    if args.metrics_log or args.metrics_port or args.profile:
+        metrics = Metrics()
+    else:
+        metrics = NullMetrics()
+    if args.metrics_log:
+        sinks.append(JsonLogSink(metrics, args.metrics_log, interval=args.metrics_interval))
+    if args.metrics_port:
+        sinks.append(PrometheusSink(metrics, args.metrics_port))
+    if args.profile:
+        sinks.append(ProfilerSink(args.profile))
+    return metrics, sinks
+
+def parse_video_source(source):
+    """ Camera indexes are given as integers to cv2.VideoCapture, anything else is a file or a URL """
+    return int(source) if source.isdigit() else source
+
+def parse_frame_size(frame_size):
+    width, height = frame_size.lower().split('x')
+    return int(width), int(height)
+
+def shared_option_default(suppress_defaults):
+    """ Subcommands get the shared options with suppressed defaults, so they keep the values given before the subcommand """
+    return (lambda value: argparse.SUPPRESS) if suppress_defaults else (lambda value: value)
+
+def create_recognizer_parser(suppress_defaults=False):
+    """ Options shared by every command """
+    default = shared_option_default(suppress_defaults)
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--resize-factor', type=float, default=default(0.25), dest="resize_factor", help='Amount to resize the video frames when processing')
+    parser.add_argument('--init-from-cache', action='store_false', default=default(True), dest="init_from_cache", help='Initialize the face recognizer from the cache')
+    parser.add_argument('--cache-path', type=str, default=default("cache"), dest="cache_path", help='Path to the cache directory for the face recognizer')
+    parser.add_argument('--expiration-time', type=int, default=default(0.5), dest="expiration_time", help='Time in hours after which a face is considered expired')
+    parser.add_argument('--ann-lists', type=int, default=default(None), dest="ann_lists", help='Search known faces through an approximate nearest-neighbor index with this many clusters. Defaults to an exact linear scan.')
+    parser.add_argument('--ann-probes', type=int, default=default(16), dest="ann_probes", help='Number of index clusters scanned per face. Higher is more accurate but slower.')
+    parser.add_argument('--metrics-log', type=str, default=default(None), dest="metrics_log", help='Append a JSON snapshot of the stage timings and counters to this file periodically')
+    parser.add_argument('--metrics-interval', type=float, default=default(10.0), dest="metrics_interval", help='Seconds between two snapshots written to --metrics-log')
+    parser.add_argument('--metrics-port', type=int, default=default(None), dest="metrics_port", help='Serve the metrics in the Prometheus format on http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--profile', type=str, default=default(None), dest="profile", help='Profile the main thread with cProfile and write the stats to this file on exit')
+    return parser
+
+def create_tracking_parser(suppress_defaults=False):
+    """ Options of the commands following faces across the frames of a live stream """
+    default = shared_option_default(suppress_defaults)
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--detection-interval', type=int, default=default(2), dest="detection_interval", help='Detect faces every N frames, faces are tracked in between')
+    parser.add_argument('--refresh-interval', type=int, default=default(30), dest="refresh_interval", help='Re-encode a tracked face after this many frames')
+    parser.add_argument('--optical-flow', action='store_true', default=default(False), dest="use_optical_flow", help='Move the tracked faces with optical flow between detections')
+    parser.add_argument('--motion-gate', action='store_true', default=default(False), dest="use_motion_gate", help='Skip face detection on frames where nothing moved, and only scan the moving regions of the others')
+    parser.add_argument('--motion-threshold', type=int, default=default(25), dest="motion_threshold", help='Grey level change for a pixel to count as moving with --motion-gate')
+    return parser
+
 if __name__ == "__main__":
     # Parse the command line arguments
-    parser = argparse.ArgumentParser(description='Face recognition using webcam')
+    parser = argparse.ArgumentParser(description='Face recognition using webcam', parents=[create_recognizer_parser(), create_tracking_parser()])
     parser.add_argument('--camera-index', type=int, default=1, dest="camera_index", help='Index of the camera to use. Defaults to 1 (external camera). 0 is the built-in camera.')
-    parser.add_argument('--resize-factor', type=float, default=0.25, dest="resize_factor", help='Amount to resize the video frames when processing')
-    parser.add_argument('--init-from-cache', action='store_false', dest="init_from_cache", help='Initialize the face recognizer from the cache')
-    parser.add_argument('--cache-path', type=str, default="cache", dest="cache_path", help='Path to the cache directory for the face recognizer')
-    parser.add_argument('--expiration-time', type=int, default=0.5, dest="expiration_time", help='Time in hours after which a face is considered expired')
+    parser.add_argument('--pipelined', action='store_true', dest="pipelined", help='Run capture, detection, matching and display as parallel stages')
+    parser.add_argument('--detection-workers', type=int, default=2, dest="detection_workers", help='Number of detection threads used by --pipelined')
+    parser.add_argument('--latency-budget-ms', type=float, default=None, dest="latency_budget_ms", help='Adapt the resize factor, detector upsampling, landmark model and jitters to process a frame within this time')
+    parser.add_argument('--target-fps', type=float, default=None, dest="target_fps", help='Same as --latency-budget-ms with a budget of 1000/FPS ms')
+    subparsers = parser.add_subparsers(dest="command", help='Run without a command to recognize faces from the webcam')
+
+    headless_parser = subparsers.add_parser('headless', parents=[create_recognizer_parser(suppress_defaults=True)], help='Recognize faces from a video file, an image directory or stdin without opening any window')
+    headless_parser.add_argument('source', type=str, help="Video file, directory of images, or '-' to read raw BGR24 frames from stdin")
+    headless_parser.add_argument('--output', type=str, default='-', dest="output", help="File the JSONL results are written to. Defaults to stdout.")
+    headless_parser.add_argument('--frame-size', type=parse_frame_size, default=None, dest="frame_size", help='WIDTHxHEIGHT of the raw frames read from stdin')
+    headless_parser.add_argument('--start-frame', type=int, default=0, dest="start_frame", help='First frame to process')
+    headless_parser.add_argument('--end-frame', type=int, default=None, dest="end_frame", help='Stop before this frame')
+    headless_parser.add_argument('--frame-stride', type=int, default=1, dest="frame_stride", help='Only process every N-th frame')
+    headless_parser.add_argument('--workers', type=int, default=1, dest="workers", help='Number of processes used to detect faces')
+
+    enroll_parser = subparsers.add_parser('enroll', parents=[create_recognizer_parser(suppress_defaults=True)], help='Add a directory of labeled photos (one sub-directory per person) to the permanent storage')
+    enroll_parser.add_argument('directory', type=str, help='Directory holding one sub-directory of photos per person, named after the person')
+    enroll_parser.add_argument('--workers', type=int, default=None, dest="workers", help='Number of processes used to encode the photos. Defaults to the number of CPUs.')
+    enroll_parser.add_argument('--dedup-threshold', type=float, default=0.15, dest="dedup_threshold", help='Skip a photo closer than this distance to an already enrolled face of the same person')
+    enroll_parser.add_argument('--checkpoint', type=str, default=None, dest="checkpoint", help='File recording the processed photos so an interrupted run resumes. Defaults to DIRECTORY/.enroll_checkpoint.jsonl')
+
+    multi_parser = subparsers.add_parser('multi', parents=[create_recognizer_parser(suppress_defaults=True), create_tracking_parser(suppress_defaults=True)], help='Recognize faces from several cameras or video files in one process, sharing the database of faces')
+    multi_parser.add_argument('sources', type=parse_video_source, nargs='+', help='Camera indexes, video files or stream URLs')
+    multi_parser.add_argument('--workers', type=int, default=None, dest="workers", help='Number of threads processing the frames of all the sources. Defaults to the number of CPUs.')
+    multi_parser.add_argument('--output', type=str, default='-', dest="output", help="File the JSONL results are written to, 'none' to disable them. Defaults to stdout.")
+    multi_parser.add_argument('--display', action='store_true', dest="display", help='Show every source in its own window')
+
+    serve_parser = subparsers.add_parser('serve', parents=[create_recognizer_parser(suppress_defaults=True)], help='Serve recognize, enroll and forget requests over HTTP on localhost or a Unix socket')
+    serve_parser.add_argument('--host', type=str, default='127.0.0.1', dest="host", help='Address the server listens on')
+    serve_parser.add_argument('--port', type=int, default=8000, dest="port", help='Port the server listens on')
+    serve_parser.add_argument('--unix-socket', type=str, default=None, dest="unix_socket", help='Listen on this Unix socket instead of a TCP port')
+    serve_parser.add_argument('--max-batch-size', type=int, default=16, dest="max_batch_size", help='Maximum number of requests processed together')
+    serve_parser.add_argument('--max-wait-ms', type=float, default=10.0, dest="max_wait_ms", help='Maximum time a request waits for its batch to fill')
+    serve_parser.add_argument('--workers', type=int, default=None, dest="workers", help='Number of threads detecting and encoding the faces of a batch. Defaults to the number of CPUs.')
+    serve_parser.add_argument('--save-interval', type=float, default=60.0, dest="save_interval", help='Seconds between two background saves of the cache')
     args = parser.parse_args()
-    stream = RecognizerStream(camera_index=args.camera_index, 
-                              resize_factor=args.resize_factor, 
-                              init_from_cache=args.init_from_cache, 
-                              cache_path=args.cache_path,
-                              expiration_time=args.expiration_time)
+    metrics, metrics_sinks = create_metrics(args)
+    for sink in metrics_sinks:
+        sink.start()
+
+    if args.command == 'headless':
+        output = sys.stdout if args.output == '-' else open(args.output, 'w')
+        try:
+            # Keep the log messages out of the results
+            with contextlib.redirect_stdout(sys.stderr):
+                face_recognizer = FaceRecognizer(init_from_cache=args.init_from_cache,
+                                                 cache_path=args.cache_path,
+                                                 expiration_time=args.expiration_time,
+                                                 ann_lists=args.ann_lists,
+                                                 ann_probes=args.ann_probes,
+                                                 metrics=metrics)
+                run_headless(face_recognizer, args.source, output,
+                             resize_factor=args.resize_factor,
+                             start_frame=args.start_frame,
+                             end_frame=args.end_frame,
+                             frame_stride=args.frame_stride,
+                             frame_size=args.frame_size,
+                             workers=args.workers)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+            for sink in metrics_sinks:
+                sink.stop()
+        exit(0)
+
+    if args.command == 'enroll':
+        face_recognizer = FaceRecognizer(init_from_cache=args.init_from_cache,
+                                         cache_path=args.cache_path,
+                                         expiration_time=args.expiration_time,
+                                         ann_lists=args.ann_lists,
+                                         ann_probes=args.ann_probes,
+                                         metrics=metrics)
+        try:
+            enroll_directory(face_recognizer.permanent_storage, args.directory,
+                             workers=args.workers,
+                             dedup_threshold=args.dedup_threshold,
+                             checkpoint_path=args.checkpoint)
+        finally:
+            for sink in metrics_sinks:
+                sink.stop()
+        exit(0)
+
+    if args.command == 'multi':
+        output = {'-': sys.stdout, 'none': None}.get(args.output) or open(args.output, 'w')
+        # Keep the log messages out of the results
+        with contextlib.redirect_stdout(sys.stderr):
+            face_recognizer = FaceRecognizer(init_from_cache=args.init_from_cache,
+                                             cache_path=args.cache_path,
+                                             expiration_time=args.expiration_time,
+                                             ann_lists=args.ann_lists,
+                                             ann_probes=args.ann_probes,
+                                             metrics=metrics)
+            runner = MultiStreamRunner(face_recognizer, args.sources,
+                                       resize_factor=args.resize_factor,
+                                       workers=args.workers,
+                                       detection_interval=args.detection_interval,
+                                       refresh_interval=args.refresh_interval,
+                                       use_optical_flow=args.use_optical_flow,
+                                       use_motion_gate=args.use_motion_gate,
+                                       motion_threshold=args.motion_threshold,
+                                       output=output,
+                                       display=args.display,
+                                       metrics=metrics)
+            try:
+                runner.run()
+            finally:
+                for sink in metrics_sinks:
+                    sink.stop()
+        if output not in (sys.stdout, None):
+            output.close()
+        exit(0)
+
+    if args.command == 'serve':
+        face_recognizer = FaceRecognizer(init_from_cache=args.init_from_cache,
+                                         cache_path=args.cache_path,
+                                         expiration_time=args.expiration_time,
+                                         ann_lists=args.ann_lists,
+                                         ann_probes=args.ann_probes,
+                                         metrics=metrics)
+        # Images are resized by --resize-factor before detection, unless a request asks for another resize factor
+        server = RecognitionServer(face_recognizer,
+                                   host=args.host,
+                                   port=args.port,
+                                   unix_socket=args.unix_socket,
+                                   resize_factor=args.resize_factor,
+                                   max_batch_size=args.max_batch_size,
+                                   max_wait=args.max_wait_ms / 1000,
+                                   workers=args.workers,
+                                   save_interval=args.save_interval,
+                                   metrics=metrics)
+        try:
+            server.serve_forever()
+        finally:
+            for sink in metrics_sinks:
+                sink.stop()
+        exit(0)
+
+    stream_options = dict(camera_index=args.camera_index, 
+                          resize_factor=args.resize_factor, 
+                          init_from_cache=args.init_from_cache, 
+                          cache_path=args.cache_path,
+                          expiration_time=args.expiration_time,
+                          ann_lists=args.ann_lists,
+                          ann_probes=args.ann_probes,
+                          detection_interval=args.detection_interval,
+                          refresh_interval=args.refresh_interval,
+                          use_optical_flow=args.use_optical_flow,
+                          use_motion_gate=args.use_motion_gate,
+                          motion_threshold=args.motion_threshold,
+                          metrics=metrics)
+    if args.latency_budget_ms or args.target_fps:
+        if args.pipelined:
+            parser.error("--latency-budget-ms and --target-fps are not supported with --pipelined")
+        stream_options['latency_budget'] = args.latency_budget_ms / 1000 if args.latency_budget_ms else 1 / args.target_fps
+    if args.pipelined:
+        stream = PipelinedRecognizerStream(detection_workers=args.detection_workers, **stream_options)
+    else:
+        stream = RecognizerStream(**stream_options)
 
     # Check if the camera is working before starting the stream
     if not stream.gui_handler.is_camera_working():
@@ -109,4 +485,8 @@ if __name__ == "__main__":
     else:
         print("Camera is working")
         # Run the program
-        stream.stream_video()
\ No newline at end of file
+        try:
+            stream.stream_video()
+        finally:
+            for sink in metrics_sinks:
+                sink.stop()
\ No newline at end of file
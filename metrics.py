@@ -0,0 +1,243 @@
+import bisect
+import cProfile
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds (in seconds) of the latency histogram buckets, the last bucket catches everything else
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, float('inf'))
+
+class Histogram():
+    __slots__ = ('counts', 'count', 'total')
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def quantile(self, q):
+        """ Upper bound of the bucket holding the q-quantile, None when it falls in the last, unbounded bucket """
+        rank = q * self.count
+        cumulative = 0
+        for upper_bound, count in zip(LATENCY_BUCKETS[:-1], self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return upper_bound
+        return None
+
+class StageTimer():
+    """ Context manager recording the time spent in a stage """
+    __slots__ = ('metrics', 'stage', 'start')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+
+class Metrics():
+    """
+    Registry of the metrics of the recognition loop:
+    - stage latency histograms, recorded with `with metrics.time('detect_faces'):`
+    - counters, e.g. faces detected, faces matched per Code, expired faces, dropped frames
+    - gauges, e.g. the size of the storages
+    Counters and gauges can carry labels, e.g. metrics.increment('faces_matched', labels={'code': 1}).
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    @staticmethod
+    def key(name, labels):
+        return (name, tuple(sorted(labels.items()))) if labels else (name, ())
+
+    def time(self, stage):
+        return StageTimer(self, stage)
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def increment(self, name, amount=1, labels=None):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set_gauge(self, name, value, labels=None):
+        key = self.key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    @staticmethod
+    def escape_label_value(value):
+        """ Escapes a label value as the Prometheus text format requires, stream labels are paths or URLs """
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    @classmethod
+    def format_name(cls, key):
+        name, labels = key
+        if not labels:
+            return name
+        return name + '{' + ','.join(f'{label}="{cls.escape_label_value(value)}"' for label, value in labels) + '}'
+
+    @staticmethod
+    def quantile_ms(histogram, q):
+        quantile = histogram.quantile(q)
+        return None if quantile is None else quantile * 1000
+
+    def snapshot(self):
+        """ Returns the current value of every metric as a JSON-serializable dict """
+        with self.lock:
+            return {'timestamp': time.time(),
+                    'stages': {stage: {'count': histogram.count,
+                                       'mean_ms': histogram.total / histogram.count * 1000 if histogram.count else None,
+                                       'p50_ms': self.quantile_ms(histogram, 0.5),
+                                       'p99_ms': self.quantile_ms(histogram, 0.99)}
+                               for stage, histogram in self.histograms.items()},
+                    'counters': {self.format_name(key): value for key, value in self.counters.items()},
+                    'gauges': {self.format_name(key): value for key, value in self.gauges.items()}}
+
+    def render_prometheus(self):
+        """ Returns the metrics in the Prometheus text exposition format """
+        lines = []
+        with self.lock:
+            if self.histograms:
+                lines.append('# TYPE face_recognition_stage_seconds histogram')
+            for stage, histogram in self.histograms.items():
+                cumulative = 0
+                for upper_bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if upper_bound == float('inf') else repr(upper_bound)
+                    lines.append(f"{self.format_name(('face_recognition_stage_seconds_bucket', (('stage', stage), ('le', le))))} {cumulative}")
+                lines.append(f"{self.format_name(('face_recognition_stage_seconds_sum', (('stage', stage),)))} {histogram.total}")
+                lines.append(f"{self.format_name(('face_recognition_stage_seconds_count', (('stage', stage),)))} {histogram.count}")
+            # Prometheus counters are suffixed with _total
+            for metric_type, suffix, values in (('counter', '_total', self.counters), ('gauge', '', self.gauges)):
+                # The samples of a family must directly follow its TYPE line
+                families = {}
+                for (name, labels), value in values.items():
+                    families.setdefault(name, []).append((labels, value))
+                for name in sorted(families):
+                    lines.append(f'# TYPE face_recognition_{name}{suffix} {metric_type}')
+                    for labels, value in families[name]:
+                        lines.append(f'face_recognition_{self.format_name((name + suffix, labels))} {value}')
+        return '\n'.join(lines) + '\n'
+
+class NullStageTimer():
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+class NullMetrics():
+    """ Drop-in replacement for Metrics when instrumentation is disabled, every call is a no-op """
+
+    enabled = False
+    timer = NullStageTimer()
+
+    def time(self, stage):
+        return self.timer
+
+    def observe(self, stage, seconds):
+        pass
+
+    def increment(self, name, amount=1, labels=None):
+        pass
+
+    def set_gauge(self, name, value, labels=None):
+        pass
+
+class JsonLogSink():
+    """ Appends a JSON snapshot of the metrics to a file every interval seconds """
+
+    def __init__(self, metrics, path, interval=10.0):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def write(self):
+        with open(self.path, 'a') as f:
+            # Infinity and NaN are not valid JSON, refuse to write them rather than corrupting the log
+            f.write(json.dumps(self.metrics.snapshot(), allow_nan=False) + '\n')
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+
+class PrometheusSink():
+    """ Serves the metrics in the Prometheus text format on http://host:port/metrics """
+
+    def __init__(self, metrics, port, host='127.0.0.1'):
+        sink_metrics = metrics
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = sink_metrics.render_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass # Scrapes would flood the console
+
+        self.server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class ProfilerSink():
+    """ Profiles the calling thread with cProfile between start() and stop(), and dumps the stats to a file """
+
+    def __init__(self, path):
+        self.path = path
+        self.profiler = cProfile.Profile()
+
+    def start(self):
+        self.profiler.enable()
+
+    def stop(self):
+        self.profiler.disable()
+        self.profiler.dump_stats(self.path)
+        print(f"Profile written to {self.path}, inspect it with python -m pstats {self.path}")
@@ -0,0 +1,81 @@
+import cv2
+import numpy as np
+
+def pad_region(region, padding, min_size, frame_shape):
+    """ Grows a (top, right, bottom, left) box by padding times its size on every side (to at least min_size), clipped to the frame """
+    top, right, bottom, left = region
+    height, width = frame_shape[:2]
+    pad_y = max(int((bottom - top) * padding), (min_size - (bottom - top)) // 2, 0)
+    pad_x = max(int((right - left) * padding), (min_size - (right - left)) // 2, 0)
+    return (max(top - pad_y, 0), min(right + pad_x, width), min(bottom + pad_y, height), max(left - pad_x, 0))
+
+def merge_regions(regions):
+    """ Replaces overlapping (top, right, bottom, left) boxes by their union until no two boxes overlap """
+    regions = list(regions)
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(regions)):
+            for j in range(i + 1, len(regions)):
+                a, b = regions[i], regions[j]
+                if a[0] < b[2] and b[0] < a[2] and a[3] < b[1] and b[3] < a[1]:
+                    regions[i] = (min(a[0], b[0]), max(a[1], b[1]), max(a[2], b[2]), min(a[3], b[3]))
+                    del regions[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return regions
+
+class MotionGate():
+    """
+    Tells which parts of a (downscaled, RGB) frame changed, so face detection can skip static frames and only scan the moving regions.
+
+    Frames are compared to a running-average background. Pixels differing by more than threshold grey levels are grouped into
+    blobs, blobs smaller than min_area (a fraction of the frame) are ignored as noise, and the remaining ones are padded by
+    padding times their size, so a face above a moving body is included. When the regions cover more than full_frame_ratio
+    of the frame, the whole frame is returned, one scan being cheaper than several overlapping ones.
+    """
+
+    def __init__(self, threshold=25, min_area=0.002, learning_rate=0.1, padding=0.5, min_region_size=64, full_frame_ratio=0.6):
+        self.threshold = threshold
+        self.min_area = min_area
+        self.learning_rate = learning_rate
+        self.padding = padding
+        self.min_region_size = min_region_size
+        self.full_frame_ratio = full_frame_ratio
+        self.background = None
+
+    def full_frame(self, frame):
+        return (0, frame.shape[1], frame.shape[0], 0)
+
+    def moving_regions(self, frame):
+        """ Returns the (top, right, bottom, left) boxes of the frame that moved since the previous calls, [] for a static frame """
+        gray_frame = cv2.GaussianBlur(cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY), (5, 5), 0)
+        if self.background is None or self.background.shape != gray_frame.shape:
+            # Everything is new on the first frame
+            self.background = gray_frame.astype(np.float32)
+            return [self.full_frame(frame)]
+
+        difference = cv2.absdiff(gray_frame, cv2.convertScaleAbs(self.background))
+        cv2.accumulateWeighted(gray_frame, self.background, self.learning_rate)
+        _, mask = cv2.threshold(difference, self.threshold, 255, cv2.THRESH_BINARY)
+        mask = cv2.dilate(mask, None, iterations=2)
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+        min_area = self.min_area * frame.shape[0] * frame.shape[1]
+        regions = []
+        for contour in contours:
+            if cv2.contourArea(contour) < min_area:
+                continue
+            x, y, width, height = cv2.boundingRect(contour)
+            regions.append(pad_region((y, x + width, y + height, x), self.padding, self.min_region_size, frame.shape))
+        return self.restrict_to_regions(frame, regions)
+
+    def restrict_to_regions(self, frame, regions):
+        """ Merges the regions to scan, or returns the whole frame when they cover most of it """
+        regions = merge_regions(regions)
+        covered_area = sum((bottom - top) * (right - left) for top, right, bottom, left in regions)
+        if covered_area > self.full_frame_ratio * frame.shape[0] * frame.shape[1]:
+            return [self.full_frame(frame)]
+        return regions
@@ -0,0 +1,160 @@
+import cv2
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from gui import VideoHandler
+from pipeline import LatestValue
+from tracker import FaceTracker
+from motion import MotionGate
+from metrics import NullMetrics
+
+class CameraStream():
+    """ One camera or video source of a MultiStreamRunner, with its own tracker deciding which frames need work """
+
+    def __init__(self, name, source, face_recognizer, resize_factor, detection_interval=2, refresh_interval=30, use_optical_flow=False,
+                 use_motion_gate=False, motion_threshold=25):
+        self.name = name
+        self.video_handler = VideoHandler(camera_index=source, resize_factor=resize_factor)
+        self.face_tracker = FaceTracker(face_recognizer,
+                                        detection_interval=detection_interval,
+                                        refresh_interval=refresh_interval,
+                                        use_optical_flow=use_optical_flow,
+                                        motion_gate=MotionGate(threshold=motion_threshold) if use_motion_gate else None)
+        # Live sources drop the frames captured while the previous one is processed, video files are processed frame by frame
+        self.is_live = not os.path.isfile(str(source))
+        self.in_flight = threading.Semaphore(1) # At most one frame of a stream is in the worker pool
+        self.captured_frames = LatestValue()
+        self.recognized_faces = LatestValue(([], []))
+
+class MultiStreamRunner():
+    """
+    Serves several camera or video sources from one process, sharing a single FaceRecognizer and a single copy of the gallery.
+
+    Every source has a capture thread and a FaceTracker. Captured frames are processed on one worker pool shared by all the
+    sources (dlib and NumPy release the GIL, so the workers run in parallel). The storages of the FaceRecognizer are guarded by
+    reader-writer locks: matching from many streams runs concurrently, while enrollments and expirations are serialized.
+
+    Unknown faces are remembered in the ephemeral storage, so a stranger walking from one entrance to the next is reported as
+    recently seen. Results are written to output as JSONL, and every stream is shown in its own window when display is set.
+    """
+
+    def __init__(self, face_recognizer, sources, resize_factor=0.25, workers=None, detection_interval=2, refresh_interval=30,
+                 use_optical_flow=False, use_motion_gate=False, motion_threshold=25, output=None, display=False, metrics=None):
+        self.face_recognizer = face_recognizer
+        self.metrics = metrics or NullMetrics()
+        # The position makes the names unique, the same source can be given twice
+        self.streams = [CameraStream(f'{i}:{source}', source, face_recognizer, resize_factor,
+                                     detection_interval=detection_interval,
+                                     refresh_interval=refresh_interval,
+                                     use_optical_flow=use_optical_flow,
+                                     use_motion_gate=use_motion_gate,
+                                     motion_threshold=motion_threshold)
+                        for i, source in enumerate(sources)]
+        self.pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+        self.output = output
+        self.output_lock = threading.Lock()
+        self.display = display
+        self.stopped = threading.Event()
+        self.threads = []
+
+    def run_capture(self, stream):
+        frame_number = 0
+        while not self.stopped.is_set():
+            ret, frame = stream.video_handler.get_frame()
+            if not ret:
+                print(f"Could not read a frame from {stream.name}, stopping the stream")
+                break
+            stream.captured_frames.set((frame_number, frame))
+            if stream.in_flight.acquire(blocking=not stream.is_live):
+                self.pool.submit(self.process_frame, stream, frame_number, frame)
+            else:
+                self.metrics.increment('frames_dropped', labels={'stage': 'detection', 'stream': stream.name})
+            frame_number += 1
+
+        # Wait for the last frame of the stream before reporting it as finished
+        stream.in_flight.acquire()
+        stream.captured_frames.close()
+
+    def process_frame(self, stream, frame_number, frame):
+        try:
+            with self.metrics.time('process_frame'):
+                small_frame = stream.video_handler.process_frame(frame)
+            tracks = stream.face_tracker.process_frame(small_frame)
+
+            for track in tracks:
+                if track.is_fresh and track.metadata['Code'] == -1:
+                    self.face_recognizer.ephemeral_storage.add_face_to_dataset(None, track.face_encoding)
+
+            face_names = [track.metadata['Name'] or 'Unknown' for track in tracks]
+            stream.recognized_faces.set(([track.face_location for track in tracks], face_names))
+            if self.output is not None:
+                self.write_result(stream, frame_number, tracks, face_names)
+        except Exception as exc:
+            print(f'{stream.name}: {type(exc).__name__}: {exc}', file=sys.stderr)
+        finally:
+            stream.in_flight.release()
+
+    def write_result(self, stream, frame_number, tracks, face_names):
+        faces = [{'name': name,
+                  'code': track.metadata['Code'],
+                  'distance': track.metadata.get('Distance'),
+                  'box': list(stream.video_handler.scale_up_boundary_box(track.face_location))}
+                 for track, name in zip(tracks, face_names)]
+        line = json.dumps({'stream': stream.name, 'frame': frame_number, 'timestamp': time.time(), 'faces': faces}) + '\n'
+        with self.output_lock:
+            self.output.write(line)
+
+    def display_streams(self, versions):
+        for i, stream in enumerate(self.streams):
+            if stream.captured_frames.closed:
+                continue
+            version, captured_frame = stream.captured_frames.get()
+            if captured_frame is None or version == versions[i]:
+                continue
+            versions[i] = version
+            face_locations, face_names = stream.recognized_faces.get()[1]
+            # Draw on a copy, a worker may still be reading the captured frame
+            stream.video_handler.display_frame_with_faces(captured_frame[1].copy(), face_locations, face_names, window_name=stream.name)
+
+    def handle_key_press(self, key):
+        if key == ord('q'):
+            return True
+        elif key == ord('s'):
+            # The storages are locked, they can be saved while the streams keep running
+            self.face_recognizer.save_cache()
+            print("Current cache of faces saved to file")
+        return False
+
+    def run(self):
+        self.threads = [threading.Thread(target=self.run_capture, args=(stream,), daemon=True) for stream in self.streams]
+        for thread in self.threads:
+            thread.start()
+
+        versions = [0] * len(self.streams)
+        try:
+            while any(thread.is_alive() for thread in self.threads):
+                if self.display:
+                    self.display_streams(versions)
+                    if self.handle_key_press(cv2.waitKey(1) & 0xFF):
+                        break
+                else:
+                    self.stopped.wait(0.1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+        self.pool.shutdown(wait=True)
+        for stream in self.streams:
+            stream.video_handler.video_capture.release()
+        self.face_recognizer.save_cache()
+        if self.display:
+            cv2.destroyAllWindows()
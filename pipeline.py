@@ -0,0 +1,137 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+class PipelineClosed(Exception):
+    """ Raised by a stage connector once the pipeline is shutting down """
+
+class DroppingQueue():
+    """
+    Bounded queue connecting two pipeline stages. put() never blocks: when the queue is full the oldest item is dropped,
+    so a slow consumer always works on the most recent items (latest-frame-wins). on_drop is called for every dropped item.
+    """
+
+    def __init__(self, maxsize, on_drop=None):
+        self.items = deque(maxlen=maxsize)
+        self.condition = threading.Condition()
+        self.closed = False
+        self.dropped = 0 # Number of items dropped because the consumer was too slow
+        self.on_drop = on_drop
+
+    def put(self, item):
+        with self.condition:
+            dropped = len(self.items) == self.items.maxlen
+            if dropped:
+                self.dropped += 1
+            self.items.append(item)
+            self.condition.notify()
+        if dropped and self.on_drop is not None:
+            self.on_drop()
+
+    def get(self):
+        """ Blocks until an item is available, raises PipelineClosed once the queue is closed """
+        with self.condition:
+            while not self.items and not self.closed:
+                self.condition.wait()
+            if self.closed:
+                raise PipelineClosed()
+            return self.items.popleft()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+class LatestValue():
+    """ Holds the most recent value published by a stage, readers can wait for a value newer than the one they have """
+
+    def __init__(self, value=None):
+        self.value = value
+        self.version = 0
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def set(self, value):
+        with self.condition:
+            self.value = value
+            self.version += 1
+            self.condition.notify_all()
+
+    def get(self):
+        with self.condition:
+            return self.version, self.value
+
+    def wait_newer(self, version, timeout=None):
+        """ Returns (version, value) once a value newer than version is published (or the timeout expires) """
+        with self.condition:
+            self.condition.wait_for(lambda: self.version > version or self.closed, timeout=timeout)
+            if self.closed:
+                raise PipelineClosed()
+            return self.version, self.value
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+class MicroBatcher():
+    """
+    Collects the items submitted by many threads into batches handed to process_batch(items), which returns one result per item.
+    A batch is processed as soon as it holds max_batch_size items, or max_wait seconds after its first item arrived.
+    submit() returns a concurrent.futures.Future resolved with the result of the item (or the exception of its batch).
+    """
+
+    def __init__(self, process_batch, max_batch_size=16, max_wait=0.01):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.items = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, item):
+        future = Future()
+        with self.condition:
+            if self.closed:
+                raise PipelineClosed()
+            self.items.append((item, future))
+            self.condition.notify()
+        return future
+
+    def next_batch(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.items or self.closed)
+            if not self.items:
+                raise PipelineClosed()
+            deadline = time.monotonic() + self.max_wait
+            while len(self.items) < self.max_batch_size and not self.closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return [self.items.popleft() for _ in range(min(len(self.items), self.max_batch_size))]
+
+    def run(self):
+        try:
+            while True:
+                batch = self.next_batch()
+                try:
+                    results = self.process_batch([item for item, _ in batch])
+                except Exception as exc:
+                    for _, future in batch:
+                        future.set_exception(exc)
+                else:
+                    for (_, future), result in zip(batch, results):
+                        future.set_result(result)
+        except PipelineClosed:
+            pass
+
+    def close(self):
+        """ Processes the items already submitted, then stops """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
@@ -0,0 +1,79 @@
+from collections import namedtuple
+
+QualityLevel = namedtuple('QualityLevel', ['resize_factor', 'max_upsample', 'landmark_model', 'num_jitters'])
+
+# From the cheapest to the most accurate settings, the default settings of the stream are (0.25, 1, 'small', 1).
+# Only the upper levels align the faces with the 'large' landmark model, the gallery is encoded with the 'small' one.
+QUALITY_LEVELS = (QualityLevel(0.2, 0, 'small', 1),
+                  QualityLevel(0.25, 1, 'small', 1),
+                  QualityLevel(0.35, 1, 'small', 1),
+                  QualityLevel(0.5, 1, 'small', 1),
+                  QualityLevel(0.5, 1, 'large', 1),
+                  QualityLevel(0.5, 2, 'large', 2),
+                  QualityLevel(0.75, 2, 'large', 3))
+
+class LatencyController():
+    """
+    Keeps the per-frame processing time within a budget (in seconds) by moving along QUALITY_LEVELS.
+
+    Only the frames where faces were detected are observed: the frames in between (tracked faces, static scenes) cost next
+    to nothing whatever the settings, they would hide the cost of a detection and let the controller climb on an empty scene.
+    The observed times are smoothed with an exponential moving average. When the average goes over the budget the controller
+    steps down to cheaper settings, when it stays under headroom times the budget it steps up to more accurate ones.
+    After a change, the controller waits cooldown_frames observed frames for the timings to reflect the new settings.
+
+    Within a level, the faces of the last detection decide how the work is spent:
+    - the detector only upsamples up to max_upsample when no face was found or the smallest face is under small_face_size
+      pixels of the resized frame (faces far from the camera), larger faces get one upsampling less
+    - encodings are only jittered when there are at most crowd_size faces, jitters cost as much as encoding the face again
+    """
+
+    def __init__(self, budget, levels=QUALITY_LEVELS, resize_factor=0.25, smoothing=0.2, headroom=0.6, cooldown_frames=15,
+                 small_face_size=80, crowd_size=3):
+        self.budget = budget
+        self.levels = levels
+        self.smoothing = smoothing
+        self.headroom = headroom
+        self.cooldown_frames = cooldown_frames
+        self.small_face_size = small_face_size
+        self.crowd_size = crowd_size
+        # Start from the most accurate level at the requested resize factor
+        self.level_index = max((i for i, level in enumerate(levels) if level.resize_factor <= resize_factor), default=0)
+        self.average_frame_time = None
+        self.frames_since_change = 0
+
+    @property
+    def level(self):
+        return self.levels[self.level_index]
+
+    def observe(self, frame_time):
+        """ Records the processing time of a frame where faces were detected, returns True when the quality level changed """
+        if self.average_frame_time is None:
+            self.average_frame_time = frame_time
+        else:
+            self.average_frame_time += self.smoothing * (frame_time - self.average_frame_time)
+        self.frames_since_change += 1
+        if self.frames_since_change < self.cooldown_frames:
+            return False
+
+        if self.average_frame_time > self.budget and self.level_index > 0:
+            self.level_index -= 1
+        elif self.average_frame_time < self.headroom * self.budget and self.level_index < len(self.levels) - 1:
+            self.level_index += 1
+        else:
+            return False
+        print(f"Frame time {self.average_frame_time * 1000:.1f} ms for a budget of {self.budget * 1000:.1f} ms, switching to {self.level}")
+        self.frames_since_change = 0
+        self.average_frame_time = None
+        return True
+
+    def detection_settings(self, face_locations):
+        """ Returns (number_of_times_to_upsample, landmark_model, num_jitters) given the faces of the last detection """
+        level = self.level
+        face_sizes = [bottom - top for top, right, bottom, left in face_locations]
+        if not face_sizes or min(face_sizes) < self.small_face_size:
+            number_of_times_to_upsample = level.max_upsample
+        else:
+            number_of_times_to_upsample = max(level.max_upsample - 1, 0)
+        num_jitters = level.num_jitters if len(face_sizes) <= self.crowd_size else 1
+        return number_of_times_to_upsample, level.landmark_model, num_jitters
@@ -0,0 +1,84 @@
+import threading
+import time
+import numpy as np
+
+from face_recognizer import DEFAULT_TOLERANCE
+
+class UnknownFaceCluster():
+    """ The sightings of one unknown person: a few diverse samples (encoding and face image) and how often it was seen """
+
+    def __init__(self, cluster_id, face_encoding, face_image):
+        self.cluster_id = cluster_id
+        self.encodings = [face_encoding]
+        self.face_images = [face_image]
+        self.sightings = 1
+        self.first_seen = self.last_seen = time.time()
+
+    def distance_to(self, face_encoding):
+        """ Distance to the nearest sample of the cluster """
+        return float(np.linalg.norm(np.asarray(self.encodings) - face_encoding, axis=1).min())
+
+class UnknownFaceQueue():
+    """
+    Pending-review queue of unknown faces, safe to use from the recognition threads and the review thread at the same time.
+
+    Unknown encodings are clustered online: an encoding within tolerance of a sample of a pending cluster joins it, anything else
+    starts a new cluster. One stranger standing in front of the camera thus produces one pending review, however many frames it
+    appears on. A cluster keeps up to max_samples samples, at least min_sample_distance apart, to show and enroll.
+    When more than max_pending clusters are waiting, the one seen least recently is dropped.
+    """
+
+    def __init__(self, tolerance=DEFAULT_TOLERANCE, max_samples=5, min_sample_distance=0.15, max_pending=20):
+        self.tolerance = tolerance
+        self.max_samples = max_samples
+        self.min_sample_distance = min_sample_distance
+        self.max_pending = max_pending
+        self.clusters = [] # Pending clusters, oldest first
+        self.next_cluster_id = 0
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def __len__(self):
+        with self.condition:
+            return len(self.clusters)
+
+    def add(self, face_encoding, face_image):
+        """ Files an unknown face under its cluster and returns the cluster """
+        face_encoding = np.asarray(face_encoding, dtype=np.float32)
+        with self.condition:
+            distances = [cluster.distance_to(face_encoding) for cluster in self.clusters]
+            if distances and min(distances) <= self.tolerance:
+                cluster = self.clusters[int(np.argmin(distances))]
+                cluster.sightings += 1
+                cluster.last_seen = time.time()
+                if len(cluster.encodings) < self.max_samples and min(distances) > self.min_sample_distance:
+                    cluster.encodings.append(face_encoding)
+                    cluster.face_images.append(face_image)
+                return cluster
+
+            cluster = UnknownFaceCluster(self.next_cluster_id, face_encoding, face_image)
+            self.next_cluster_id += 1
+            self.clusters.append(cluster)
+            if len(self.clusters) > self.max_pending:
+                self.clusters.remove(min(self.clusters, key=lambda cluster: cluster.last_seen))
+            self.condition.notify_all()
+            return cluster
+
+    def wait_next(self, timeout=None):
+        """ Blocks until a cluster is pending and returns the oldest one (it stays pending until resolved), None on timeout or close """
+        with self.condition:
+            self.condition.wait_for(lambda: self.clusters or self.closed, timeout=timeout)
+            if self.closed or not self.clusters:
+                return None
+            return self.clusters[0]
+
+    def resolve(self, cluster):
+        """ Takes a reviewed cluster out of the queue """
+        with self.condition:
+            if cluster in self.clusters:
+                self.clusters.remove(cluster)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
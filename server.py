@@ -0,0 +1,204 @@
+import cv2
+import json
+import os
+import socketserver
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+
+from pipeline import MicroBatcher
+from metrics import NullMetrics
+
+ENDPOINTS = ('/recognize', '/enroll', '/forget', '/health')
+
+class RequestError(Exception):
+    """ Raised while handling a request that cannot be served, carries the HTTP status to answer with """
+
+    def __init__(self, status, message):
+        super(RequestError, self).__init__(message)
+        self.status = status
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def decode_image(body):
+    """ Decodes an encoded image (JPEG, PNG, ...) into an RGB array """
+    image = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR) if body else None
+    if image is None:
+        raise RequestError(400, "The request body is not an image")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+class RecognitionServer():
+    """
+    Serves a warm FaceRecognizer to local clients over HTTP, on a TCP port of localhost or on a Unix socket.
+
+    POST /recognize           body: an image. Answers {'faces': [{'name', 'code', 'distance', 'box'}]}, boxes are (top, right, bottom, left)
+    POST /enroll?name=NAME    body: an image showing exactly one face, added to the permanent storage. Answers {'face_id'}
+    POST /forget?name=NAME    removes every face of the person from both storages. Answers {'removed'}
+    GET  /health              answers the number of faces in each storage
+
+    Recognize and enroll requests of all the clients are collected into micro-batches (up to max_batch_size requests, waiting
+    at most max_wait seconds for the batch to fill). The images of a batch are detected and encoded in parallel on a thread
+    pool, then all their faces are matched with a single vectorized call and enrolled with a single batch insert.
+    The cache is saved every save_interval seconds in the background, and when the server stops.
+    """
+
+    def __init__(self, face_recognizer, host='127.0.0.1', port=8000, unix_socket=None, resize_factor=1.0, max_batch_size=16,
+                 max_wait=0.01, workers=None, save_interval=60.0, metrics=None):
+        self.face_recognizer = face_recognizer
+        self.resize_factor = resize_factor
+        self.metrics = metrics or NullMetrics()
+        self.save_interval = save_interval
+        self.pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+        self.batcher = MicroBatcher(self.process_batch, max_batch_size=max_batch_size, max_wait=max_wait)
+        self.stopped = threading.Event()
+        self.save_thread = threading.Thread(target=self.run_periodic_save, daemon=True)
+
+        handler = self.create_request_handler()
+        self.unix_socket = unix_socket
+        if unix_socket:
+            if os.path.exists(unix_socket):
+                os.remove(unix_socket)
+            self.server = ThreadingUnixHTTPServer(unix_socket, handler)
+        else:
+            self.server = ThreadingHTTPServer((host, port), handler)
+
+    def detect_faces(self, image, resize_factor):
+        small_image = image if resize_factor == 1 else cv2.resize(image, (0, 0), fx=resize_factor, fy=resize_factor)
+        face_locations, face_encodings = self.face_recognizer.detect_faces(small_image)
+        # Scale the boxes back to the coordinates of the image
+        return [tuple(int(x / resize_factor) for x in face_location) for face_location in face_locations], face_encodings
+
+    def detect_faces_of_request(self, request):
+        """ Returns the detections of a request, or the RequestError answering it, so one bad image cannot fail the whole batch """
+        try:
+            return self.detect_faces(request[1], request[2].get('resize_factor', self.resize_factor))
+        except Exception as exc:
+            return RequestError(500, f'{type(exc).__name__}: {exc}')
+
+    def process_batch(self, requests):
+        """ Handles a batch of (operation, image, parameters) requests, returns one response (or RequestError) per request """
+        self.metrics.increment('server_batches')
+        self.metrics.increment('server_batched_requests', len(requests))
+        detections = list(self.pool.map(self.detect_faces_of_request, requests))
+        responses = [detection if isinstance(detection, RequestError) else None for detection in detections]
+
+        # Match the faces of all the recognize requests at once
+        recognize_indices = [i for i, request in enumerate(requests) if request[0] == 'recognize' and responses[i] is None]
+        face_encodings = [face_encoding for i in recognize_indices for face_encoding in detections[i][1]]
+        faces_metadata = iter(self.face_recognizer.retrieve_metadata_from_faces(face_encodings))
+        for i in recognize_indices:
+            responses[i] = {'faces': [{'name': metadata['Name'],
+                                       'code': metadata['Code'],
+                                       'distance': metadata.get('Distance'),
+                                       'box': list(face_location)}
+                                      for face_location, metadata in zip(detections[i][0], faces_metadata)]}
+
+        # Enroll the faces of all the enroll requests at once
+        enroll_indices = []
+        for i, request in enumerate(requests):
+            if request[0] != 'enroll' or responses[i] is not None:
+                continue
+            if len(detections[i][1]) != 1:
+                responses[i] = RequestError(422, f"The image must show exactly one face, {len(detections[i][1])} found")
+            else:
+                enroll_indices.append(i)
+        if enroll_indices:
+            face_ids = self.face_recognizer.permanent_storage.add_faces_to_dataset([requests[i][2]['name'] for i in enroll_indices],
+                                                                                   [detections[i][1][0] for i in enroll_indices])
+            for i, face_id in zip(enroll_indices, face_ids.tolist()):
+                print(f"Adding {requests[i][2]['name']} to the database")
+                responses[i] = {'face_id': face_id}
+        return responses
+
+    def handle_request(self, method, path, query, body):
+        """ Returns the JSON-serializable response to a request, raises RequestError for the requests that cannot be served """
+        if method == 'GET' and path == '/health':
+            return {'ephemeral_faces': len(self.face_recognizer.ephemeral_storage),
+                    'permanent_faces': len(self.face_recognizer.permanent_storage)}
+        if method != 'POST' or path not in ENDPOINTS[:3]:
+            raise RequestError(404, f"Unknown endpoint {method} {path}")
+
+        name = query.get('name', [None])[0]
+        if path in ('/enroll', '/forget') and not name:
+            raise RequestError(400, "The name parameter is required")
+        if path == '/forget':
+            return {'removed': self.face_recognizer.forget(name)}
+
+        parameters = {'name': name}
+        if 'resize_factor' in query:
+            try:
+                parameters['resize_factor'] = float(query['resize_factor'][0])
+            except ValueError:
+                raise RequestError(400, "resize_factor must be a number")
+            if not parameters['resize_factor'] > 0:
+                raise RequestError(400, "resize_factor must be greater than 0")
+        response = self.batcher.submit((path[1:], decode_image(body), parameters)).result()
+        if isinstance(response, RequestError):
+            raise response
+        return response
+
+    def create_request_handler(self):
+        recognition_server = self
+
+        class RecognitionRequestHandler(BaseHTTPRequestHandler):
+            def handle_method(self, method):
+                url = urlparse(self.path)
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                stage = 'server' + url.path.replace('/', '_') if url.path in ENDPOINTS else 'server_unknown'
+                try:
+                    with recognition_server.metrics.time(stage):
+                        status, response = 200, recognition_server.handle_request(method, url.path, parse_qs(url.query), body)
+                except RequestError as exc:
+                    status, response = exc.status, {'error': str(exc)}
+                except Exception as exc:
+                    status, response = 500, {'error': f'{type(exc).__name__}: {exc}'}
+                self.send_json(status, response)
+
+            def send_json(self, status, response):
+                body = json.dumps(response).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self.handle_method('GET')
+
+            def do_POST(self):
+                self.handle_method('POST')
+
+            def log_message(self, *args):
+                pass # Requests would flood the console
+
+        return RecognitionRequestHandler
+
+    def run_periodic_save(self):
+        while not self.stopped.wait(self.save_interval):
+            self.face_recognizer.save_cache()
+
+    def serve_forever(self):
+        print(f"Serving face recognition on {self.unix_socket or 'http://%s:%d' % self.server.server_address[:2]}")
+        self.save_thread.start()
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def stop(self):
+        """ Makes serve_forever() return, from another thread """
+        self.server.shutdown()
+
+    def close(self):
+        self.stopped.set()
+        self.server.server_close()
+        self.batcher.close()
+        self.pool.shutdown(wait=True)
+        self.face_recognizer.save_cache()
+        if self.unix_socket and os.path.exists(self.unix_socket):
+            os.remove(self.unix_socket)
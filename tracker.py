@@ -0,0 +1,164 @@
+import cv2
+import numpy as np
+
+from motion import pad_region
+
+class Track():
+    """ A face followed across frames, with the encoding and identity computed the last time it was encoded """
+
+    __slots__ = ('track_id', 'face_location', 'face_encoding', 'metadata', 'last_encoded_frame', 'missed_detections', 'is_fresh')
+
+    def __init__(self, track_id, face_location):
+        self.track_id = track_id
+        self.face_location = face_location # (top, right, bottom, left), like face_recognition
+        self.face_encoding = None
+        self.metadata = None
+        self.last_encoded_frame = None
+        self.missed_detections = 0
+        self.is_fresh = False # True when the identity was (re)computed on the current frame
+
+def intersection_over_union(face_locations_a, face_locations_b):
+    """ Returns the (len(a), len(b)) IoU matrix of two lists of (top, right, bottom, left) boxes """
+    a = np.asarray(face_locations_a, dtype=np.float64).reshape(-1, 1, 4)
+    b = np.asarray(face_locations_b, dtype=np.float64).reshape(1, -1, 4)
+    heights = np.clip(np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]), 0, None)
+    widths = np.clip(np.minimum(a[..., 1], b[..., 1]) - np.maximum(a[..., 3], b[..., 3]), 0, None)
+    intersections = heights * widths
+    areas_a = (a[..., 2] - a[..., 0]) * (a[..., 1] - a[..., 3])
+    areas_b = (b[..., 2] - b[..., 0]) * (b[..., 1] - b[..., 3])
+    return intersections / np.maximum(areas_a + areas_b - intersections, 1e-9)
+
+class FaceTracker():
+    """
+    Sits between face detection and face matching and decides, frame by frame, which work is actually needed:
+    - Faces are only detected every detection_interval frames. In between, the boxes of the tracks are kept as they are,
+      or moved along with the image content when use_optical_flow is set.
+    - Detections are associated with the existing tracks by IoU. Only new tracks, and tracks whose encoding is older
+      than refresh_interval frames, are encoded and matched again. The other tracks reuse their cached identity.
+    - Tracks of unknown faces are matched again on every detection, with their cached encoding, so they pick up the
+      identity given to them as soon as it is stored.
+    - With a motion_gate (see motion.MotionGate), detection is skipped on frames where nothing moved, and otherwise only
+      runs on the moving regions and around the current tracks.
+    After every frame, ran_detection tells whether the detector actually ran on it.
+    """
+
+    def __init__(self, face_recognizer, detection_interval=2, refresh_interval=30, iou_threshold=0.3, max_missed_detections=2, use_optical_flow=False,
+                 motion_gate=None):
+        self.face_recognizer = face_recognizer
+        self.detection_interval = detection_interval
+        self.refresh_interval = refresh_interval
+        self.iou_threshold = iou_threshold
+        self.max_missed_detections = max_missed_detections
+        self.use_optical_flow = use_optical_flow
+        self.motion_gate = motion_gate
+        self.tracks = []
+        self.next_track_id = 0
+        self.frame_number = -1
+        self.last_detection_frame = None
+        self.previous_gray_frame = None
+        self.ran_detection = False
+
+    def rescale(self, scale):
+        """ Follows a change of the size of the frames: scales the boxes of the tracks and restarts the motion models """
+        for track in self.tracks:
+            track.face_location = tuple(int(x * scale) for x in track.face_location)
+        self.previous_gray_frame = None
+        if self.motion_gate is not None:
+            self.motion_gate.background = None
+
+    def visible_tracks(self):
+        return [track for track in self.tracks if track.missed_detections == 0]
+
+    def associate(self, face_locations):
+        """ Greedily pairs tracks and detections by decreasing IoU, starts a track for every unpaired detection """
+        unpaired_detections = set(range(len(face_locations)))
+        unpaired_tracks = set(range(len(self.tracks)))
+        if self.tracks and face_locations:
+            ious = intersection_over_union([track.face_location for track in self.tracks], face_locations)
+            for flat_index in np.argsort(ious, axis=None)[::-1]:
+                track_index, detection_index = np.unravel_index(flat_index, ious.shape)
+                if ious[track_index, detection_index] < self.iou_threshold:
+                    break
+                if track_index in unpaired_tracks and detection_index in unpaired_detections:
+                    self.tracks[track_index].face_location = tuple(face_locations[detection_index])
+                    self.tracks[track_index].missed_detections = 0
+                    unpaired_tracks.discard(track_index)
+                    unpaired_detections.discard(detection_index)
+
+        for track_index in unpaired_tracks:
+            self.tracks[track_index].missed_detections += 1
+        self.tracks = [track for track in self.tracks if track.missed_detections <= self.max_missed_detections]
+        for detection_index in sorted(unpaired_detections):
+            self.tracks.append(Track(self.next_track_id, tuple(face_locations[detection_index])))
+            self.next_track_id += 1
+
+    def propagate_with_optical_flow(self, gray_frame):
+        """ Shifts every visible track by the median motion of the corners found inside its box """
+        if self.previous_gray_frame is None or self.previous_gray_frame.shape != gray_frame.shape:
+            return
+        for track in self.visible_tracks():
+            top, right, bottom, left = track.face_location
+            mask = np.zeros_like(gray_frame)
+            mask[max(top, 0):bottom, max(left, 0):right] = 255
+            points = cv2.goodFeaturesToTrack(self.previous_gray_frame, maxCorners=20, qualityLevel=0.01, minDistance=3, mask=mask)
+            if points is None:
+                continue
+            moved_points, status, _ = cv2.calcOpticalFlowPyrLK(self.previous_gray_frame, gray_frame, points, None)
+            tracked = status.ravel() == 1
+            if not tracked.any():
+                continue
+            dx, dy = np.median((moved_points - points).reshape(-1, 2)[tracked], axis=0)
+            dx, dy = int(round(dx)), int(round(dy))
+            track.face_location = (top + dy, right + dx, bottom + dy, left + dx)
+
+    def detect_face_locations(self, frame):
+        if self.motion_gate is None:
+            self.ran_detection = True
+            return self.face_recognizer.detect_face_locations(frame)
+
+        regions = self.motion_gate.moving_regions(frame)
+        if not regions:
+            # Nothing moved, the faces are still where they were
+            self.face_recognizer.metrics.increment('detections_skipped')
+            return [track.face_location for track in self.visible_tracks()]
+
+        # Also look around the current tracks, so faces standing still are not lost while someone else moves
+        self.ran_detection = True
+        regions += [pad_region(track.face_location, self.motion_gate.padding, self.motion_gate.min_region_size, frame.shape)
+                    for track in self.visible_tracks()]
+        return self.face_recognizer.detect_face_locations(frame, self.motion_gate.restrict_to_regions(frame, regions))
+
+    def process_frame(self, frame):
+        """ Returns the tracks visible on this frame. Tracks with is_fresh set had their identity computed on this frame. """
+        self.frame_number += 1
+        self.ran_detection = False
+        for track in self.tracks:
+            track.is_fresh = False
+
+        if self.use_optical_flow:
+            gray_frame = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+            self.propagate_with_optical_flow(gray_frame)
+            self.previous_gray_frame = gray_frame
+
+        if self.last_detection_frame is not None and self.frame_number - self.last_detection_frame < self.detection_interval:
+            return self.visible_tracks()
+        self.last_detection_frame = self.frame_number
+        self.associate(self.detect_face_locations(frame))
+        tracks = self.visible_tracks()
+
+        # Only encode the faces we know nothing about, or whose encoding is getting old
+        tracks_to_encode = [track for track in tracks
+                            if track.face_encoding is None or self.frame_number - track.last_encoded_frame >= self.refresh_interval]
+        face_encodings = self.face_recognizer.encode_faces(frame, [track.face_location for track in tracks_to_encode])
+        for track, face_encoding in zip(tracks_to_encode, face_encodings):
+            track.face_encoding = face_encoding
+            track.last_encoded_frame = self.frame_number
+
+        tracks_to_match = [track for track in tracks
+                           if track.last_encoded_frame == self.frame_number or track.metadata['Code'] == -1]
+        if tracks_to_match:
+            faces_metadata = self.face_recognizer.retrieve_metadata_from_faces([track.face_encoding for track in tracks_to_match])
+            for track, metadata in zip(tracks_to_match, faces_metadata):
+                track.metadata = metadata
+                track.is_fresh = True
+        return tracks